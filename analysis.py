@@ -1,18 +1,126 @@
 # -*- coding: utf-8 -*-
+import os
+import hashlib
+import contextlib
 import numpy as np
+from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
 import matplotlib.pyplot as plt
 from matplotlib.ticker import ScalarFormatter
 
+from annihilation import iter_coords, load_coords, read_header
+
 def iso_in_plots(isotope:str):
     """Returns the isotope in a fancier way for plots"""
     symbol = ''.join([i for i in isotope if i.isalpha()])
     number = ''.join([i for i in isotope if i.isdigit()])
     return f"{symbol}-{number}"
 
+def bin_coords(xp, yp, zp, SIZE:list[int], STEP:list[float]):
+    """Bins annihilation coords (cm, centered at 0,0,0) into the image and the 1D aPSF histograms.
+    Voxel indices are computed once per axis and shared by the image and the 1D histograms.
+    Returns img (NX,NY,NZ) and the (aPSFx, aPSFy, aPSFz) counts, all float64."""
+    idx_3D = []
+    counts_1D = []
+    valid = np.ones(len(xp), dtype=bool)
+    for p, N, d in zip((xp, yp, zp), SIZE, STEP):
+        idx = np.floor(p/d + N/2).astype(np.intp)      # x -> i = floor(x/dx + NX/2)
+        valid &= (idx >= 0) & (idx < N)                 # dont consider points beyond the image
+        idx_3D.append(idx)
+
+        # 1D histograms follow np.histogram: bins [edge_i, edge_i+1) with the last one closed,
+        # so indices are corrected against the exact edges (floor can be off by one on the edges)
+        edges = np.linspace(-N*d/2, N*d/2, N+1, dtype=np.result_type(N*d/2, p))
+        inside = (p >= edges[0]) & (p <= edges[-1])
+        hp, hidx = p[inside], np.clip(idx[inside], 0, N-1)
+        hidx[hp < edges[hidx]] -= 1
+        hidx[(hp >= edges[hidx+1]) & (hidx != N-1)] += 1
+        counts_1D.append(np.bincount(hidx, minlength=N).astype('float64'))
+
+    flat = np.ravel_multi_index([idx[valid] for idx in idx_3D], SIZE)
+    img = np.bincount(flat, minlength=np.prod(SIZE)).astype('float64').reshape(SIZE)
+    return img, counts_1D
+
 class PRAnalysis:
-    def __init__(self, label:str, file:str, SIZE:list[int], STEP:list[float],  raw_format='float32'): 	# vox_size in cm
-        """vox_size and data from file in cm"""
+    """Positron range analysis of an annihilation sample (.dat/.bin coords or .raw image).
+    Every quantity (img, aPSFx/y/z, rp, g3D, G3D, aPSF3D, rsort, G3D_nohist, ...) is computed and cached 
+    on first access, so only what is used is ever loaded or processed. Use drop() to free cached quantities."""
+    def _load(self):
+        """Loads the sample from file (in cm). Returns a dict with the quantities that come straight from loading"""
+        match self.file.split('.')[-1]:  # file extension
+            case 'dat' | 'bin' if self.chunk_size:
+                ##LOAD AND PROCESS ANNIHILATION COORDS (in cm) CHUNK BY CHUNK
+                return self._stream_dat()    # !!!!! MUST BE CENTERED AT 0,0,0 !!!!!
+
+            case 'dat' | 'bin':
+                ##LOAD ANNIHILATION COORDS (in cm)
+                data = load_coords(self.file)   # !!!!! MUST BE CENTERED AT 0,0,0 !!!!!
+                return {'xp': data[:, 0], 
+                        'yp': data[:, 1], 
+                        'zp': data[:, 2],
+                        'wp': None,
+                        'dpoints': data.shape[0],   # number of 3D points
+                        'dsize': data.shape[0]}     # size of the sample
+
+            case 'raw':
+                ##LOAD
+                with open(self.file, 'rb') as f:
+                    raw_data = np.fromfile(f, dtype=self.raw_format)
+                img = np.reshape(raw_data, (self.NX, self.NY, self.NZ))
+                
+                ##PROCESS
+                nonempty = img > 0
+                wp = img[nonempty].astype('float64')    # number of counts in each non-empty voxel
+                
+                #get coords of the non-empty voxel centres (weighted by their counts, not repeated)
+                coor = np.argwhere(nonempty)            # same (C) order as img[nonempty]
+                return {'xp': (coor[:,0]-self.NX//2)*self.dx,   # i -> x = (i - NX//2)*self.dx
+                        'yp': (coor[:,1]-self.NY//2)*self.dy,
+                        'zp': (coor[:,2]-self.NZ//2)*self.dz,
+                        'wp': wp,
+                        'dpoints': len(wp),
+                        'dsize': np.sum(img, dtype=np.int64),
+                        'img': img,
+                        'aPSF': [np.sum(np.sum(img, 2), 1).astype('float64'),
+                                 np.sum(np.sum(img, 2), 0).astype('float64'),
+                                 np.sum(np.sum(img, 1), 0).astype('float64')]}
+
+    def _stream_dat(self):
+        """Accumulates img, aPSF counts, radial distances and maxima chunk by chunk.
+        Only the radial distances of the whole sample are kept (xp, yp, zp are None)."""
+        SIZE = [self.NX, self.NY, self.NZ]
+        STEP = [self.dx, self.dy, self.dz]
+        img = np.zeros(SIZE)
+        aPSF = [np.zeros(N) for N in SIZE]
+        maxima = [-np.inf]*3
+        rp = []
+        for data in iter_coords(self.file, self.chunk_size):
+            xp, yp, zp = data[:, 0], data[:, 1], data[:, 2]
+            chunk_img, chunk_aPSF = bin_coords(xp, yp, zp, SIZE, STEP)
+            img += chunk_img
+            for counts, chunk_counts in zip(aPSF, chunk_aPSF):
+                counts += chunk_counts
+
+            rp.append(np.sqrt(xp**2 + yp**2 + zp**2))  # cm
+            maxima = [max(m, np.max(p)) for m, p in zip(maxima, (xp, yp, zp))]
+
+        rp = np.concatenate(rp)
+        return {'xp': None, 'yp': None, 'zp': None, 'wp': None,
+                'dpoints': len(rp), 'dsize': len(rp),
+                'img': img, 'aPSF': aPSF, 'rp': rp, 
+                'xmax': maxima[0], 'ymax': maxima[1], 'zmax': maxima[2]}
+
+    def __init__(self, label:str, file:str, SIZE:list[int], STEP:list[float],  raw_format='float32', chunk_size:int=None): 	# vox_size in cm
+        """vox_size and data from file in cm
+        chunk_size: if given, .dat/.bin files are streamed in blocks of chunk_size rows to bound memory (xp, yp, zp are not kept)"""
+        if file.split('.')[-1] not in ('dat', 'bin', 'raw'):
+            raise FileNotFoundError("Used a not considered file format. Please use raw, dat or bin.")
         self.label = label
+        self.file = file
+        self.raw_format = raw_format
+        self.chunk_size = chunk_size
+        self.meta = read_header(file) if file.endswith('.bin') else None
 
         self.NX, self.NY, self.NZ = SIZE
         self.dx, self.dy, self.dz = STEP #cm
@@ -28,102 +136,166 @@ class PRAnalysis:
         self.aPSFy_range = (np.arange(0, self.NY) - self.NY // 2) * self.dy
         self.aPSFz_range = (np.arange(0, self.NZ) - self.NZ // 2) * self.dz
 
-        """---------------------------------------------------
-        ------LOAD  AND PROCESS DATA------
-        ---------------------------------------------------"""
-        match file.split('.')[-1]:  # file extension
-            case 'dat':
-                ##LOAD ANNIHILATION COORDS (in cm)
-                data = np.loadtxt(file)     # !!!!! MUST BE CENTERED AT 0,0,0 !!!!!
-                self.xp = data[:, 0]
-                self.yp = data[:, 1]
-                self.zp = data[:, 2]
-                
-                ##PROCESS
-                self.dpoints = data.shape[0]        # number of 3D points
-                self.dsize= self.dpoints            # size of the sample
-                
-                #get img from coords  
-                self.img = np.zeros((self.NX, self.NY, self.NZ))
-                Xp = np.floor(self.xp/self.dx + self.NX/2).astype(int)         # x -> i = floor(x/self.dx + NX/2)
-                Yp = np.floor(self.yp/self.dy + self.NY/2).astype(int)
-                Zp = np.floor(self.zp/self.dz + self.NZ/2).astype(int)
-                for t in range(self.dpoints):
-                    if Xp[t] >= self.NX or Yp[t] >= self.NY or Zp[t] >= self.NZ or \
-                       Xp[t] < 0 or Yp[t] < 0 or Zp[t] < 0:
-                        continue    # dont consider points beyond the image
-
-                    self.img[Xp[t], Yp[t], Zp[t]] += 1
-                
-                #get normalised aPSF
-                self.aPSFx = np.histogram(self.xp, bins=self.NX, range=[-self.Xmax, self.Xmax])[0].astype('float64')
-                self.aPSFy = np.histogram(self.yp, bins=self.NY, range=[-self.Ymax, self.Ymax])[0].astype('float64')
-                self.aPSFz = np.histogram(self.zp, bins=self.NZ, range=[-self.Zmax, self.Zmax])[0].astype('float64')
-
-            case 'raw':
-                ##LOAD
-                with open(file, 'rb') as f:
-                    raw_data = np.fromfile(f, dtype=raw_format)
-                self.img = np.reshape(raw_data, (self.NX, self.NY, self.NZ))
-                
-                ##PROCESS
-                self.dpoints = len(self.img[self.img > 0])
-                self.dsize= np.sum(self.img, dtype=np.intc)
-                
-                #get coords from img  
-                coor = np.zeros((self.dsize, 3))
-                n = 0
-                for ijk in np.argwhere(self.img>0)[:]:
-                    r = int(self.img[ ijk[0], ijk[1], ijk[2] ])  # number of counts in voxel ijk
-                    coor[n:n+r,:] = np.repeat([ijk], r, axis=0)  # repeat ijk row number-of-counts times
-                    n += r                                       # update index for coords
-                self.xp = (coor[:,0]-self.NX//2)*self.dx         # i -> x = (i - NX//2)*self.dx
-                self.yp = (coor[:,1]-self.NY//2)*self.dy
-                self.zp = (coor[:,2]-self.NZ//2)*self.dz
-                
-                #get normalised aPSF
-                self.aPSFx = np.sum(np.sum(self.img, 2), 1).astype('float64')
-                self.aPSFy = np.sum(np.sum(self.img, 2), 0).astype('float64')
-                self.aPSFz = np.sum(np.sum(self.img, 1), 0).astype('float64')
-            case _:
-                raise FileNotFoundError("Used a not considered file format. Please use raw or dat.")
-
-        # normalise aPSF   
-        self.aPSFx /= np.sum(self.aPSFx)
-        self.aPSFy /= np.sum(self.aPSFy)
-        self.aPSFz /= np.sum(self.aPSFz)
-
-        # aPSF_sin
-        self.aPSFx_sin = self.aPSFx / np.max(self.aPSFx)
-        self.aPSFy_sin = self.aPSFy / np.max(self.aPSFy)
-        self.aPSFz_sin = self.aPSFz / np.max(self.aPSFz)
-
-        ##MORE PROCESSING
-        #radial distance traveled
-        self.rp = np.sqrt(self.xp**2 + self.yp**2 + self.zp**2) # cm
-
-        #maxima reached
-        self.rmax = np.max(self.rp)     # cm
-        self.xmax = np.max(self.xp)
-        self.ymax = np.max(self.yp)
-        self.zmax = np.max(self.zp)
-
-        #radial stuff (normalised)
-        rrange = np.arange(0, self.rmax, self.dr)
-        self.rplot = rrange[:-1] + self.dr/2
-        #---radial annihilation distribution: g3D(r) = 4pi r^2 * aPSF3D(r)
-        self.g3D = np.histogram(self.rp, bins=rrange)[0]
-        self.g3D = self.g3D / np.sum(self.g3D)
-        #---cumulative radial annihilation distribution: G3D(r) = int_0^r g3D(r') dr'
-        self.G3D = np.cumsum(self.g3D) 
-        #---radial annihilation Point Spread Function: aPSF3D(r)
-        self.aPSF3D	= self.g3D / self.rplot**2
-        self.aPSF3D = self.aPSF3D / np.sum(self.aPSF3D)
-        self.aPSF3D_sin = self.aPSF3D / np.max(self.aPSF3D)
-
-        #---cummulative radial distribution without histograms: G3D(r) = (i+1)/N for i=0..N-1
-        self.rsort = np.sort(self.rp)
-        self.G3D_nohist = np.arange(1, self.dsize+1)/self.dsize
+    def drop(self, *names:str):
+        """Frees cached quantities (they are recomputed on next access). 
+        img also frees the image kept by the loaded sample, xp/yp/zp free the coords (see release_coords).
+        Without names everything is dropped, including the loaded sample (reloaded from file if needed)"""
+        if not names:
+            names = [name for name in self.__dict__ if isinstance(getattr(type(self), name, None), cached_property)]
+        cached = [name for name, attr in vars(type(self)).items() if isinstance(attr, cached_property)]
+        unknown = set(names) - set(cached) - {'img', 'xp', 'yp', 'zp'}
+        if unknown:
+            raise KeyError(f"{unknown} are not cached quantities. Cached quantities are {['img', 'xp', 'yp', 'zp'] + cached}")
+
+        sample = self.__dict__.get('_sample', {})
+        for name in names:
+            if name == 'img':
+                self.__dict__.pop('_binned', None)
+                sample.pop('img', None)
+                sample.pop('aPSF', None)
+            elif name in ('xp', 'yp', 'zp'):
+                sample.pop(name, None)
+            else:
+                self.__dict__.pop(name, None)
+
+    def release_coords(self):
+        """Frees the xp, yp, zp coords, keeping the computed rp and maxima in the sample (so they are not 
+        recomputed from the coords). The coords are reloaded from file if they are accessed again"""
+        if '_sample' in self.__dict__:
+            for name in ('rp', 'xmax', 'ymax', 'zmax'):
+                if name in self.__dict__:
+                    self._sample[name] = self.__dict__[name]
+            for axis in ('xp', 'yp', 'zp'):
+                self._sample.pop(axis, None)
+        return self
+
+    def compute(self, *names:str):
+        """Computes (and caches) the given quantities, or every public one if no names are given"""
+        names = names or [name for name, attr in vars(type(self)).items() 
+                          if isinstance(attr, cached_property) and not name.startswith('_')]
+        for name in names:
+            getattr(self, name)
+        return self
+
+    """---------------------------------------------------
+    ------LOADED DATA------
+    ---------------------------------------------------"""
+    @cached_property
+    def _sample(self):
+        return self._load()
+
+    def _coords(self, axis:str):
+        if axis not in self._sample:    # released (see release_coords): reloaded from file
+            loaded = self._load()
+            self._sample.update({key: loaded[key] for key in ('xp', 'yp', 'zp')})
+        return self._sample[axis]
+
+    @property
+    def xp(self): return self._coords('xp')
+    @property
+    def yp(self): return self._coords('yp')
+    @property
+    def zp(self): return self._coords('zp')
+    @property
+    def wp(self): return self._sample['wp']     # weight of each point (counts of each voxel for raw images, None if every point counts once)
+    @property
+    def dpoints(self): return self._sample['dpoints']
+    @property
+    def dsize(self): return self._sample['dsize']
+
+    """---------------------------------------------------
+    ------IMAGE AND 1D aPSF------
+    ---------------------------------------------------"""
+    @cached_property
+    def _binned(self):
+        sample = self._sample
+        if 'img' not in sample and sample.get('xp', 0) is None:
+            sample = self._load()    # image dropped from a streamed/rehydrated sample: processed again from file
+        if 'img' in sample:
+            return sample['img'], sample['aPSF']
+        #get img and aPSF from coords (single vectorized pass)
+        coords = [sample[axis] if axis in sample else getattr(self, axis) for axis in ('xp', 'yp', 'zp')]
+        return bin_coords(*coords, [self.NX, self.NY, self.NZ], [self.dx, self.dy, self.dz])
+
+    @property
+    def img(self): return self._binned[0]
+
+    # normalised aPSF
+    @cached_property
+    def aPSFx(self): return self._binned[1][0] / np.sum(self._binned[1][0])
+    @cached_property
+    def aPSFy(self): return self._binned[1][1] / np.sum(self._binned[1][1])
+    @cached_property
+    def aPSFz(self): return self._binned[1][2] / np.sum(self._binned[1][2])
+
+    # aPSF_sin
+    @cached_property
+    def aPSFx_sin(self): return self.aPSFx / np.max(self.aPSFx)
+    @cached_property
+    def aPSFy_sin(self): return self.aPSFy / np.max(self.aPSFy)
+    @cached_property
+    def aPSFz_sin(self): return self.aPSFz / np.max(self.aPSFz)
+
+    """---------------------------------------------------
+    ------RADIAL PROCESSING------
+    ---------------------------------------------------"""
+    #radial distance traveled
+    @cached_property
+    def rp(self):
+        if 'rp' in self._sample:     # already computed if streamed
+            return self._sample['rp']
+        return np.sqrt(self.xp**2 + self.yp**2 + self.zp**2) # cm
+
+    #maxima reached
+    @cached_property
+    def rmax(self): return np.max(self.rp)     # cm
+    @cached_property
+    def xmax(self): return self._sample['xmax'] if 'xmax' in self._sample else np.max(self.xp)
+    @cached_property
+    def ymax(self): return self._sample['ymax'] if 'ymax' in self._sample else np.max(self.yp)
+    @cached_property
+    def zmax(self): return self._sample['zmax'] if 'zmax' in self._sample else np.max(self.zp)
+
+    #radial stuff (normalised)
+    @cached_property
+    def _rrange(self): return np.arange(0, self.rmax, self.dr)
+    @cached_property
+    def rplot(self): return self._rrange[:-1] + self.dr/2
+
+    #---radial annihilation distribution: g3D(r) = 4pi r^2 * aPSF3D(r)
+    @cached_property
+    def g3D(self):
+        g3D = np.histogram(self.rp, bins=self._rrange, weights=self.wp)[0]
+        return g3D / np.sum(g3D)
+
+    #---cumulative radial annihilation distribution: G3D(r) = int_0^r g3D(r') dr'
+    @cached_property
+    def G3D(self): return np.cumsum(self.g3D)
+
+    #---radial annihilation Point Spread Function: aPSF3D(r)
+    @cached_property
+    def aPSF3D(self):
+        aPSF3D = self.g3D / self.rplot**2
+        return aPSF3D / np.sum(aPSF3D)
+    @cached_property
+    def aPSF3D_sin(self): return self.aPSF3D / np.max(self.aPSF3D)
+
+    #---cummulative radial distribution without histograms: G3D(r) = (i+1)/N for i=0..N-1
+    @cached_property
+    def _isort(self): return np.argsort(self.rp)
+
+    @cached_property
+    def rsort(self):
+        if self.wp is None:
+            return np.sort(self.rp)
+        return self.rp[self._isort]
+
+    @cached_property
+    def G3D_nohist(self):
+        if self.wp is None:
+            return np.arange(1, self.dsize+1)/self.dsize
+        # weighted points: G3D jumps by the weight of each point
+        return np.cumsum(self.wp[self._isort])/np.sum(self.wp)
 
     def interpol_G3D(self, val):
         """Interpolates the value of G3D(r) for a given results object"""
@@ -135,6 +307,121 @@ class PRAnalysis:
         return x1 + (x2-x1)*(val-y1)/(y2-y1)
     
 
+class ResultsCache:
+    """Content-addressed on-disk cache of processed PRAnalysis results.
+    Entries are keyed by the hash of the file content and the SIZE, STEP and raw_format used to process it, 
+    and store img, the 1D aPSF counts, the sorted radial distances (and weights) and the scalars in a compressed npz.
+    Rehydrated results do not keep the xp, yp, zp coords (like streamed ones). 
+    The least recently used entries are evicted when the cache exceeds max_bytes."""
+    def __init__(self, cache_dir:str=".prcache", max_bytes:int=int(10e9)):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def file_hash(file:str, block_size:int=2**20):
+        """Returns the sha256 hash of the content of file (read in blocks)"""
+        h = hashlib.sha256()
+        with open(file, 'rb') as f:
+            while block := f.read(block_size):
+                h.update(block)
+        return h.hexdigest()[:32]
+
+    def _path(self, file:str, SIZE:list[int], STEP:list[float], raw_format:str):
+        params = repr(([int(n) for n in SIZE], [float(d) for d in STEP], str(raw_format)))
+        params_hash = hashlib.sha256(params.encode('utf-8')).hexdigest()[:16]
+        return f"{self.cache_dir}/{self.file_hash(file)}-{params_hash}.npz"
+
+    def load(self, label:str, file:str, SIZE:list[int], STEP:list[float], raw_format='float32', chunk_size:int=None):
+        """Returns the PRAnalysis of file, rehydrated from the cache if possible (processed and stored otherwise)"""
+        path = self._path(file, SIZE, STEP, raw_format)
+        result = PRAnalysis(label, file, SIZE, STEP, raw_format, chunk_size)
+        try:
+            os.utime(path)      # mark as recently used
+            self._rehydrate(result, path)
+        except FileNotFoundError:   # not cached (or evicted by another process meanwhile)
+            self._store(result, path)
+            self._evict()
+        return result
+
+    def _store(self, result:PRAnalysis, path:str):
+        arrays = {'img': result.img,
+                  'aPSFx': result._binned[1][0],
+                  'aPSFy': result._binned[1][1],
+                  'aPSFz': result._binned[1][2],
+                  'rsort': result.rsort,
+                  'dpoints': result.dpoints,
+                  'dsize': result.dsize,
+                  'xmax': result.xmax,
+                  'ymax': result.ymax,
+                  'zmax': result.zmax}
+        if result.wp is not None:
+            arrays['wsort'] = result.wp[result._isort]
+
+        tmp = f"{path}.{os.getpid()}.tmp"     # unique per process
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, path)   # never leave half-written entries
+
+    @staticmethod
+    def _rehydrate(result:PRAnalysis, path:str):
+        with np.load(path) as data:
+            rsort = data['rsort']
+            wsort = data['wsort'] if 'wsort' in data.files else None
+            result.__dict__['_sample'] = {'xp': None, 'yp': None, 'zp': None, 
+                                          'wp': wsort,
+                                          'rp': rsort,     # order does not matter for rp
+                                          'dpoints': data['dpoints'][()],
+                                          'dsize': data['dsize'][()],
+                                          'img': data['img'],
+                                          'aPSF': [data['aPSFx'], data['aPSFy'], data['aPSFz']],
+                                          'xmax': data['xmax'][()], 
+                                          'ymax': data['ymax'][()], 
+                                          'zmax': data['zmax'][()]}
+        # rp is already sorted
+        result.__dict__['rsort'] = rsort
+        result.__dict__['_isort'] = np.arange(len(rsort))
+
+    def _entries(self):
+        """Returns the cache entries as (path, size, last use) from least to most recently used"""
+        entries = []
+        for f in os.scandir(self.cache_dir):
+            if not f.name.endswith('.npz'):
+                continue
+            with contextlib.suppress(FileNotFoundError):    # removed by another process meanwhile
+                st = f.stat()
+                entries.append((f.path, st.st_size, st.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries[:-1]:     # always keep the newest entry
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+
+    def invalidate(self, file:str=None):
+        """Removes the cache entries of file (every processing of its content), or all entries if no file is given"""
+        prefix = self.file_hash(file) if file else ''
+        for path, _, _ in self._entries():
+            if os.path.basename(path).startswith(prefix):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def size(self):
+        """Returns the total size of the cache in bytes"""
+        return sum(size for _, size, _ in self._entries())
+
+
+def _load_worker(spec:tuple, quantities:tuple, cache:ResultsCache):
+    """Loads and processes a (label, file, SIZE, STEP[, raw_format, chunk_size]) spec in a worker process.
+    The raw coords are released before the result is sent back, only the computed quantities go through the pipe"""
+    result = cache.load(*spec) if cache else PRAnalysis(*spec)
+    return result.compute(*quantities).release_coords()
+
 class GetResults:
     def _filterResults(self, labels):
         if not labels:
@@ -216,16 +503,37 @@ class GetResults:
 
         #plt.show()
 
-    def __init__(self, verbose=False): 	
+    def __init__(self, verbose=False, cache:ResultsCache=None): 	
+        """cache: if given, results are loaded through this on-disk cache of processed results"""
         self.verbose = verbose
+        self.cache = cache
         self.active_results = dict()
     
-    def load(self, label:str, file:str, vox_num:list[int], vox_size:list[float],  raw_format='float32'):    # vox_size in cm
-        result = PRAnalysis(label, file, vox_num, vox_size, raw_format)
+    def load(self, label:str, file:str, vox_num:list[int], vox_size:list[float],  raw_format='float32', chunk_size:int=None):    # vox_size in cm
+        if self.cache:
+            result = self.cache.load(label, file, vox_num, vox_size, raw_format, chunk_size)
+        else:
+            result = PRAnalysis(label, file, vox_num, vox_size, raw_format, chunk_size)
         self.active_results.update({label:result})
         if self.verbose:
             print(f"{label} loaded")
 
+    def load_many(self, specs:list[tuple], workers:int=None, quantities:tuple=(), progress=True):
+        """Loads and processes several results in parallel processes.
+        specs: list of (label, file, SIZE, STEP[, raw_format, chunk_size]) as in load
+        workers: number of processes (all cpus by default)
+        quantities: PRAnalysis quantities computed in the workers (all of them by default)"""
+        loaded = dict()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_load_worker, tuple(spec), tuple(quantities), self.cache): spec[0] for spec in specs}
+            for future in tqdm(as_completed(futures), total=len(futures), disable=not progress):
+                loaded[futures[future]] = future.result()
+        
+        # keep the order of the specs
+        self.active_results.update({spec[0]: loaded[spec[0]] for spec in specs})
+        if self.verbose:
+            print(f"{', '.join(spec[0] for spec in specs)} loaded")
+
     def remove(self, label:str):
         if label in self.active_results.keys():
             self.active_results.pop(label)
@@ -252,7 +560,7 @@ class GetResults:
 
         print("Average radial distance traveled simulated:")
         for label, result in results.items():
-            print(f"     {label:<40}\t{np.mean(result.rp)*10:>10.2f} mm")
+            print(f"     {label:<40}\t{np.average(result.rp, weights=result.wp)*10:>10.2f} mm")
 
         print("Cummulative distances:")
         for label, result in results.items():
@@ -0,0 +1,90 @@
+"""
+Annihilation coords (x, y, z in cm) are stored either as ascii files (.dat, one point per row)
+or in a compact binary container (.bin):
+    - MAGIC (8 bytes)
+    - json header padded with spaces up to HEADER_SIZE bytes (npoints, isotope, material, program, seed, nhist)
+    - npoints x 3 little-endian float32 coords, row-major
+The binary container is opened with np.memmap, so slicing it does not copy or parse anything.
+"""
+import os
+import json
+import itertools
+import numpy as np
+
+MAGIC = b'PRXYZ\x00\x01\x00'
+HEADER_SIZE = 512
+META_KEYS = ('isotope', 'material', 'program', 'seed', 'nhist')
+
+def read_header(file:str):
+    """Returns the header of a binary annihilation file as a dict"""
+    with open(file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{file}' is not a binary annihilation file")
+        header = f.read(HEADER_SIZE - len(MAGIC))
+    return json.loads(header.decode('utf-8'))
+
+def load_bin(file:str):
+    """Memory-maps the coords of a binary annihilation file as a read-only (npoints, 3) float32 array"""
+    npoints = read_header(file)['npoints']
+    return np.memmap(file, dtype='<f4', mode='r', offset=HEADER_SIZE, shape=(npoints, 3))
+
+def load_coords(file:str):
+    """Loads annihilation coords from an ascii (.dat) or binary (.bin) file"""
+    match file.split('.')[-1]:
+        case 'dat':
+            return np.loadtxt(file, ndmin=2)
+        case 'bin':
+            return load_bin(file)
+        case _:
+            raise FileNotFoundError("Used a not considered file format. Please use dat or bin.")
+
+def iter_coords(file:str, chunk_size:int=int(1e6)):
+    """Yields the rows of an annihilation file in blocks of at most chunk_size rows (2D arrays).
+    Only one block of text and coords is held in memory at a time (binary files yield memmap views)."""
+    if file.endswith('.bin'):
+        data = load_bin(file)
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i+chunk_size]
+        return
+
+    with open(file, 'r') as f:
+        while lines := list(itertools.islice(f, chunk_size)):
+            yield np.loadtxt(lines, ndmin=2)
+
+def dat2bin(file_in:str, file_out:str=None, chunk_size:int=int(1e6), keep_ascii=True, **meta):
+    """Converts an ascii annihilation file into the binary container, streaming chunk_size rows at a time.
+    The container is written to a temporary file and only renamed to file_out once complete, so a failed 
+    conversion never leaves a corrupt .bin. keep_ascii=False removes file_in after a successful conversion.
+    meta: isotope, material, program, seed, nhist (stored in the header)"""
+    unknown = set(meta) - set(META_KEYS)
+    if unknown:
+        raise KeyError(f"Unknown header fields {unknown}. Available fields are {META_KEYS}")
+    if not file_out:
+        file_out = file_in.rsplit('.', 1)[0] + '.bin'
+    if file_in == file_out:
+        raise ValueError("Input and output files must be different for security reasons")
+
+    npoints = 0
+    tmp = f"{file_out}.{os.getpid()}.tmp"     # unique per process
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(bytes(HEADER_SIZE))     # placeholder until npoints is known
+            for data in iter_coords(file_in, chunk_size):
+                if data.shape[1] != 3:
+                    raise ValueError("Input file should have 3 columns")
+                data.astype('<f4').tofile(f)
+                npoints += len(data)
+
+            header = json.dumps({'npoints': npoints, **dict.fromkeys(META_KEYS), **meta}, default=str).encode('utf-8')
+            if len(header) > HEADER_SIZE - len(MAGIC):
+                raise ValueError("Header fields are too long")
+            f.seek(0)
+            f.write(MAGIC + header.ljust(HEADER_SIZE - len(MAGIC)))
+        os.replace(tmp, file_out)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    if not keep_ascii:
+        os.remove(file_in)
+    return file_out
@@ -1,3 +1,6 @@
+import io
+import os
+import functools
 import numpy as np
 from scipy.special import gamma
 
@@ -50,6 +53,58 @@ def Fermi_factor(_Z, _E):
     F = prefactor * radial_term * exponential_term * gamma_term
     return F
 
+FERMI_ELIM = (1e-4, 20.0)   # Energy range of the Fermi tables (MeV)
+
+def _exponential_exponent(_Z, _E):
+    """pi*eta of the Fermi function, which varies too fast at low energies to be interpolated"""
+    W = _E + mc2
+    beta = np.sqrt(W**2 - mc2**2) / W
+    return -np.pi * _Z * alpha / beta
+
+@functools.lru_cache(maxsize=None)
+def _fermi_table(_Z, n_points=4096):
+    """log(F) - 2*pi*eta of Fermi_factor on a log-spaced energy grid (computed once per Z).
+    Removing 2*pi*eta (exp(pi*eta) and the asymptotic |gamma|^2) leaves a smooth function of log(E)."""
+    logE = np.linspace(np.log(FERMI_ELIM[0]), np.log(FERMI_ELIM[1]), n_points)
+    E = np.exp(logE)
+    return logE, np.log(Fermi_factor(_Z, E)) - 2*_exponential_exponent(_Z, E)
+
+def Fermi_table(_Z, _E):
+    """
+    Fermi_factor interpolated from a table cached per Z (see _fermi_table).
+    Energies outside FERMI_ELIM (MeV) are computed directly with Fermi_factor.
+    """
+    _E = np.asarray(_E, dtype=np.float64)
+    E = np.atleast_1d(_E)
+    F = np.empty_like(E)
+    inside = (E >= FERMI_ELIM[0]) & (E <= FERMI_ELIM[1])
+    logE, logF = _fermi_table(_Z)
+    F[inside] = np.exp(np.interp(np.log(E[inside]), logE, logF) + 2*_exponential_exponent(_Z, E[inside]))
+    if not inside.all():
+        F[~inside] = Fermi_factor(_Z, E[~inside])
+    return F.reshape(_E.shape)
+
+def check_fermi_tables(folder="fermi"):
+    """
+    Compares the Fermi functions with the reference tables folder/<isotope>_01.txt (positron column) and
+    the interpolated Fermi_table with the direct Fermi_factor.
+    Returns:
+        dict: {isotope: (max. relative difference Fermi_table vs Fermi_factor, 
+                         max. relative difference Fermi_factor vs reference above 10 keV)}
+    """
+    checks = dict()
+    for file in sorted(os.listdir(folder)):
+        iso = file.split('_')[0]
+        if iso not in SB and iso not in MB:
+            continue
+        Z = (SB | MB)[iso]['Z'] - 1     # daughter nucleus, as in beta_spectrum
+        E, F_ref = np.loadtxt(os.path.join(folder, file))[:, 0:3:2].T
+        E, F_ref = E[E > 1e-2], F_ref[E > 1e-2]
+        F = Fermi_factor(Z, E)
+        checks[iso] = (np.max(np.abs(Fermi_table(Z, E)/F - 1)), np.max(np.abs(F/F_ref - 1)))
+        print(f"{iso:<5} table vs direct: {checks[iso][0]:.1e}\tdirect vs {file}: {checks[iso][1]:.1e}")
+    return checks
+
 def shape_factor(_nature, _Z, _A, _Q, _E):
     """
     Calculate the shape factor for a nuclear beta decay transition.
@@ -92,7 +147,7 @@ def shape_factor(_nature, _Z, _A, _Q, _E):
             raise ValueError("Invalid nature of decay. Choose among 'allowed', 'first-forbidden' or 'first-forbidden unique'.")
     return S
 
-def beta_spectrum(_Q, _Z, _A, _nature='allowed'):
+def beta_spectrum(_Q, _Z, _A, _nature='allowed', _step=1):
     """
     Calculate the beta decay energy spectrum for a given nuclear transition.
     Parameters:
@@ -105,6 +160,8 @@ def beta_spectrum(_Q, _Z, _A, _nature='allowed'):
         _nature : str, optional
             The nature of the beta transition, e.g., 'allowed', 'forbidden', etc.
             Default is 'allowed'.
+        _step : float, optional
+            Energy step in keV. Default is 1 keV.
     Returns:
         E : numpy.ndarray
             Array of beta particle energies in keV.
@@ -125,14 +182,14 @@ def beta_spectrum(_Q, _Z, _A, _nature='allowed'):
     """
     
     # Init
-    E = np.arange(1e-10, _Q, 1) # keV
+    E = np.arange(1e-10, _Q, _step) # keV
     mc2keV = mc2 * 1e3 # MeV to keV
 
     # Calculate the beta spectrum without Coulomb correction
     N0 = np.sqrt(E**2 + 2*E*mc2keV) * (_Q - E)**2 * (E + mc2keV)
     
     # Coulomb correction using Fermi factor
-    F = Fermi_factor(_Z-1, E*1e-3)
+    F = Fermi_table(_Z-1, E*1e-3)
     S = shape_factor(_nature, _Z-1, _A, _Q*1e-3, E*1e-3) 
     N = N0*F*S
     return E, N/N.sum(), N0/N0.sum()
@@ -202,4 +259,100 @@ SB = {
         'A': 64,
         'branches': [('allowed',  653,    278,     1.0)],
     },
-}
\ No newline at end of file
+}
+
+
+### Spectrum registry ###
+@functools.lru_cache(maxsize=None)
+def get_spectrum(Q, Z, A, nature='allowed', step=1):
+    """
+    Cached beta_spectrum keyed by (Q, Z, A, nature, step). 
+    The returned arrays are shared by all callers, so they are read-only (copy them to modify).
+    """
+    spectrum = beta_spectrum(Q, Z, A, nature, step)
+    for array in spectrum:
+        array.flags.writeable = False
+    return spectrum
+
+@functools.lru_cache(maxsize=None)
+def _mixture(Z, A, branches:tuple, step):
+    spectra = [get_spectrum(Q, Z, A, nat, step)[1] for nat, Q, _, _ in branches]
+    weights = np.array([w for _, _, _, w in branches])
+    E = np.arange(1e-10, max(Q for _, Q, _, _ in branches), step)    # every branch grid is a prefix of this one
+    N = np.zeros(len(E))
+    for w, NF in zip(weights / weights.sum(), spectra):
+        N[:len(NF)] += w * NF
+    E.flags.writeable = N.flags.writeable = False
+    return E, N
+
+def isotope_spectrum(iso:str, step=1):
+    """
+    Cached emission spectrum of an SB/MB isotope (keV, probability per bin): its branches weighted as in SB/MB.
+    """
+    if iso not in SB and iso not in MB:
+        raise KeyError(f"Undefined isotope: {iso}. Available isotopes are {list(SB) + list(MB)}")
+    data = (SB | MB)[iso]
+    return _mixture(data['Z'], data['A'], tuple(map(tuple, data['branches'])), step)
+
+class AliasSampler:
+    """
+    Walker/Vose alias table to sample energies from a binned spectrum in O(1) per sample.
+    E (keV) are the lower bin edges; samples are uniform inside each bin of width step.
+    """
+    def __init__(self, E, N, step=1):
+        p = np.asarray(N, dtype=np.float64)
+        p = p / p.sum() * len(p)
+        self.E = np.asarray(E, dtype=np.float64)
+        self.step = step
+        self.prob = np.ones(len(p))
+        self.alias = np.arange(len(p))
+        small = list(np.flatnonzero(p < 1))
+        large = list(np.flatnonzero(p >= 1))
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = p[s]
+            self.alias[s] = l
+            p[l] -= 1 - p[s]
+            (small if p[l] < 1 else large).append(l)
+
+    def sample(self, size, rng=None):
+        """Returns size energies (keV)"""
+        rng = np.random.default_rng(rng)
+        k = rng.integers(0, len(self.prob), size)
+        k = np.where(rng.random(size) < self.prob[k], k, self.alias[k])
+        return self.E[k] + rng.random(size) * self.step
+
+@functools.lru_cache(maxsize=None)
+def isotope_sampler(iso:str, step=1):
+    """Cached AliasSampler of isotope_spectrum"""
+    return AliasSampler(*isotope_spectrum(iso, step), step)
+
+def _format_penEasy(E, N):
+    spec = np.column_stack((E*1e3, N))   # eV
+    spec = np.vstack((spec, np.array([spec[-1,0], -1])))    # -1 ends the table
+    f = io.StringIO()
+    np.savetxt(f, spec, header='Energy(eV) probability', fmt="%8.7e\t%10.9f")
+    return f.getvalue()
+
+def _format_gate(E, N):
+    f = io.StringIO()
+    np.savetxt(f, np.column_stack((E*1e-3, N)), header='3\t0', comments='', fmt="%.6g")   # UserSpectrum mode 3 (MeV)
+    return f.getvalue()
+
+SPECTRUM_FORMATS = {'penEasy': _format_penEasy, 'GATE': _format_gate}
+
+def write_spectrum(E, N, file:str, fmt='penEasy'):
+    """
+    Writes a spectrum (E in keV) in the spectrum file format of a simulator (see SPECTRUM_FORMATS),
+    only if the file content changes. Returns True if the file was written.
+    """
+    if fmt not in SPECTRUM_FORMATS:
+        raise KeyError(f"Unknown spectrum format {fmt}. Available formats are {list(SPECTRUM_FORMATS)}")
+    text = SPECTRUM_FORMATS[fmt](E, N)
+    if os.path.isfile(file):
+        with open(file, 'r') as f:
+            if f.read() == text:
+                return False
+    with open(file, 'w') as f:
+        f.write(text)
+    return True
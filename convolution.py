@@ -0,0 +1,164 @@
+"""
+Blurring of 3D activity volumes (e.g. the ACTIVITY arrays of InputEditor.get_newSource) with an aPSF kernel
+(e.g. from kernel.VG), so the positron range is applied to a source distribution.
+The convolution is done by FFT with overlap-add over blocks of the volume, in float32 (complex64 spectra).
+The kernel spectra are kept per FFT shape, so blurring several volumes with the same kernel and blocks
+only transforms the kernel once.
+Heterogeneous phantoms (InputEditor.get_newMaterial) are blurred per material/density group with
+density-scaled kernels (the range scales as 1/density, as seen in study3).
+"""
+import itertools
+import time
+import numpy as np
+from scipy import fft, ndimage
+from kernel import AQ
+
+class FFTBlur:
+    """
+    Convolves 3D volumes with a fixed kernel ('same' output, zero outside the volume).
+
+    Parameters:
+        kernel (numpy.ndarray): 3D kernel with odd sizes, centred on its middle voxel
+        block (int or list): Block size in voxels per axis for overlap-add. None transforms the whole volume at once
+        workers (int): Threads used by scipy.fft (None for scipy's default)
+    """
+    def __init__(self, kernel, block=None, workers=None):
+        self.kernel = np.asarray(kernel, dtype=np.float32)
+        if self.kernel.ndim != 3 or any(n % 2 == 0 for n in self.kernel.shape):
+            raise ValueError("Kernel must be 3D with odd sizes to be centred.")
+        self.block = [block]*3 if isinstance(block, int) else block
+        self.workers = workers
+        self._spectra = {}
+
+    def spectrum(self, fshape):
+        """Kernel spectrum for an FFT shape (computed once per shape)"""
+        fshape = tuple(fshape)
+        if fshape not in self._spectra:
+            self._spectra[fshape] = fft.rfftn(self.kernel, fshape, workers=self.workers)
+        return self._spectra[fshape]
+
+    def __call__(self, activity):
+        """
+        Returns the blurred activity (float32, same shape as activity).
+        Blocks without activity are skipped, so sparse sources are cheap.
+        """
+        activity = np.asarray(activity, dtype=np.float32)
+        if activity.ndim != 3:
+            raise ValueError("Activity must be a 3D volume.")
+        K = np.array(self.kernel.shape)
+        A = np.array(activity.shape)
+        B = A if self.block is None else np.minimum(self.block, A)
+        fshape = [fft.next_fast_len(int(n), real=True) for n in B + K - 1]
+        H = self.spectrum(fshape)
+
+        full = np.zeros(A + K - 1, dtype=np.float32)
+        for origin in itertools.product(*(range(0, a, b) for a, b in zip(A, B))):
+            block = activity[tuple(slice(o, o+b) for o, b in zip(origin, B))]
+            if not block.any():
+                continue
+            conv = fft.irfftn(fft.rfftn(block, fshape, workers=self.workers) * H, fshape, workers=self.workers)
+            out = tuple(slice(o, o+n+k-1) for o, n, k in zip(origin, block.shape, K))
+            full[out] += conv[tuple(slice(0, n+k-1) for n, k in zip(block.shape, K))]
+
+        return full[tuple(slice(k//2, k//2+a) for k, a in zip(K, A))]
+
+    def many(self, activities):
+        """Blurs several volumes with the same kernel (the kernel spectra are reused)"""
+        return [self(activity) for activity in activities]
+
+class HeterogeneousBlur:
+    """
+    Spatially varying blurring of an activity volume in a heterogeneous phantom.
+    Voxels are grouped by (material, density); the activity of each group is convolved with the kernel of 
+    its material scaled to its density, and the blurred groups are summed. Each positron is blurred with 
+    the medium where it is emitted (boundary crossings are not modelled).
+    The kernel of a (material, density) is the kernel of the reference density with voxels STEP*density/ref_density,
+    i.e. the same mass thickness, and is computed once and kept with its spectra.
+
+    Parameters:
+        dists (dict): {material index: (dist_aPSF3D, reference density in g/cm3)}, dist_aPSF3D as in VG
+        STEP (list): Voxel dimensions in cm [dx, dy, dz]
+        SIZE (list): Kernel size in voxels [nx, ny, nz] (should cover the range of the lowest density)
+        rlim (tuple): (rmin, rmax) Range of distances in mm of the reference density
+        method (function): Kernel integrator with the signature of kernel.AQ / kernel.VG
+        block (int or list): Overlap-add block size (see FFTBlur)
+        decimals (int): Densities are rounded to these decimals to group voxels
+        kernel_kwargs: Passed to method
+    """
+    def __init__(self, dists:dict, STEP, SIZE, rlim=(0, None), method=AQ, block=None, decimals=3, **kernel_kwargs):
+        self.dists = dists
+        self.STEP = STEP
+        self.SIZE = SIZE
+        self.rlim = rlim
+        self.method = method
+        self.block = block
+        self.decimals = decimals
+        self.kernel_kwargs = kernel_kwargs
+        self._blurrers = {}
+
+    def blurrer(self, material:int, density:float):
+        """FFTBlur with the kernel of a material at a density (computed once)"""
+        key = (int(material), round(float(density), self.decimals))
+        if key not in self._blurrers:
+            if key[0] not in self.dists:
+                raise KeyError(f"No aPSF3D for material {key[0]}. Available materials are {list(self.dists)}")
+            dist_aPSF3D, ref_density = self.dists[key[0]]
+            STEP = [s*key[1]/ref_density for s in self.STEP]
+            kernel = self.method(dist_aPSF3D, STEP, self.SIZE, self.rlim, **self.kernel_kwargs)
+            self._blurrers[key] = FFTBlur(kernel, self.block)
+        return self._blurrers[key]
+
+    def __call__(self, activity, MATERIAL, DENSITY):
+        """Returns the blurred activity (float32) given the MATERIAL and DENSITY volumes of the phantom"""
+        activity = np.asarray(activity, dtype=np.float32)
+        if not activity.shape == np.shape(MATERIAL) == np.shape(DENSITY):
+            raise ValueError("activity, MATERIAL and DENSITY must have the same shape.")
+        groups, labels = np.unique(np.stack([np.ravel(MATERIAL), np.round(np.ravel(DENSITY), self.decimals)], axis=1),
+                                   axis=0, return_inverse=True)
+        labels = labels.reshape(activity.shape)
+
+        blurred = np.zeros_like(activity)
+        for g, (material, density) in enumerate(groups):
+            source = np.where(labels == g, activity, 0)
+            if source.any():
+                blurred += self.blurrer(material, density)(source)
+        return blurred
+
+def blur(activity, kernel, block=None, workers=None):
+    """Convolves a 3D activity volume with a kernel by FFT (see FFTBlur)"""
+    return FFTBlur(kernel, block, workers)(activity)
+
+def direct_blur(activity, kernel):
+    """Direct (spatial) convolution, as reference for FFTBlur"""
+    return ndimage.convolve(np.asarray(activity, dtype=np.float32), np.asarray(kernel, dtype=np.float32),
+                            mode='constant', cval=0.0)
+
+def benchmark(activity, kernel, blocks=(None,), repeats=3, direct=True):
+    """
+    Times FFTBlur (for each block size) against the direct convolution and prints the max. relative difference.
+
+    Returns:
+        dict: {method: best time in s}
+    """
+    def best_time(func):
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - t0)
+        return min(times), result
+
+    timings = {}
+    reference = None
+    if direct:
+        timings['direct'], reference = best_time(lambda: direct_blur(activity, kernel))
+        print(f"direct: {timings['direct']:.3f} s")
+    for block in blocks:
+        blurrer = FFTBlur(kernel, block)
+        name = f"fft block={block}"
+        timings[name], result = best_time(lambda: blurrer(activity))
+        info = f"{name}: {timings[name]:.3f} s"
+        if reference is not None:
+            info += f" (max. rel. diff. {np.abs(result - reference).max()/np.abs(reference).max():.1e})"
+        print(info)
+    return timings
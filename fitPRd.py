@@ -1,14 +1,62 @@
+import os
 import lmfit
+import functools
 import numpy as np
 import sympy as sp
 from scipy.special import gamma
 
+from annihilation import iter_coords
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
 from IPython.display import display
 import warnings
 warnings.filterwarnings('ignore')
 sp.init_printing()
 
 x = sp.symbols('x')
+
+# Compilation cache: sympy expressions hash by structure, so every FitG3D built from the same expression
+# (e.g. the same MBfit_function) shares the derivatives and lambdified functions
+@functools.lru_cache(maxsize=None)
+def _derivatives(G3D):
+    """Returns the sympy g3D and aPSF3D of a G3D expression"""
+    g3D = sp.diff(G3D, x)
+    return g3D, g3D / x**2
+
+@functools.lru_cache(maxsize=None)
+def _compile(expr, consts:tuple, params:tuple):
+    """Lambdifies expr(x, *params) with the constants substituted"""
+    return sp.lambdify([x, *params], expr.subs(dict(consts)), 'numpy')
+
+@functools.lru_cache(maxsize=None)
+def _compile_jacobian(expr, consts:tuple, params:tuple):
+    """Lambdifies the gradient of expr(x, *params) with respect to params, as a (len(params), len(x)) array"""
+    expr = expr.subs(dict(consts))
+    npgrad = sp.lambdify([x, *params], [sp.diff(expr, p) for p in params], 'numpy')
+    def jacobian(xdata, *values):
+        return np.array([np.broadcast_to(g, np.shape(xdata)) for g in npgrad(xdata, *values)], dtype=float)
+    return jacobian
+
+_bootstrap_args = dict()    # shared sample and nominal fit of the bootstrap replicas of a worker process
+
+def _init_bootstrap(shm_name, size, fit_func, nominal, rmin, n_knots):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _bootstrap_args.update(shm=shm, sample=np.ndarray(size, dtype=np.float64, buffer=shm.buf), 
+                           fit_func=fit_func, nominal=nominal, rmin=rmin, n_knots=n_knots)
+
+def _bootstrap_replica(seed):
+    """Refits one resampling (with replacement) of the shared sorted sample, starting from the nominal fit"""
+    sample, fit_func = _bootstrap_args['sample'], _bootstrap_args['fit_func']
+    s = len(sample)
+    counts = np.bincount(np.random.default_rng(seed).integers(0, s, s), minlength=s)
+    replica = np.repeat(sample, counts)     # already sorted
+    r_knots, G3D_knots, weights, _ = compress_G3D(replica, (np.arange(1, s+1) - 0.5)/s, _bootstrap_args['n_knots'])
+    fit_func.init_params = list(_bootstrap_args['nominal'])
+    fit_func.fit(r_knots, G3D_knots, _bootstrap_args['rmin'], weights=weights)
+    return fit_func.fitted_params
+
 class FitG3D:
     def __init__(self, sympy_function, constants:dict, params:dict, name:str):
         self.name = name
@@ -19,8 +67,7 @@ class FitG3D:
         self.consts = constants         # constant parameters
         
         self.spG3D = sympy_function # G3D
-        self.spg3D = sp.diff(sympy_function, x)  # g3D
-        self.spaPSF3D = self.spg3D / x**2 # aPSF3D
+        self.spg3D, self.spaPSF3D = _derivatives(sympy_function)  # g3D, aPSF3D
         
         self.fitted_params = None
         self.fitted_params_err = None
@@ -28,38 +75,117 @@ class FitG3D:
         self.chi2 = None
         self.rmse = None
         self.stderr = None
+        self.nfev = None
 
-    def fit(self, xdata, ydata, rmin=0.0):
+    def fit(self, xdata, ydata, rmin=0.0, analytic_jac=False, method=None, weights=None):
+        """Fits G3D to (xdata, ydata) for xdata > rmin. 
+        weights: residual weights, e.g. sqrt of the points represented by each knot of compress_G3D 
+        (residual, rmse and chi2 are then those of the represented sample).
+        With analytic_jac (opt-in) the compiled sympy gradient is given to the optimiser instead of finite differences.
+        It needs fewer model evaluations, but each evaluation costs more, and it is slower than leastsq on the G3D
+        samples (see benchmark_jacobian), so the default stays the finite differences leastsq fit.
+        method: lmfit method, by default the trust region 'least_squares' with analytic_jac (it handles the bounds
+        itself, so the gradient is not distorted by lmfit's bound transform) and 'leastsq' without."""
+        w2 = np.ones(np.sum(xdata > rmin)) if weights is None else weights[xdata > rmin]**2
+        weights = None if weights is None else weights[xdata > rmin]
         ydata = ydata[xdata > rmin]
         xdata = xdata[xdata > rmin]
-        G3D = self.spG3D.subs(self.consts)
-        npG3D = sp.lambdify([x,*self.params], G3D, 'numpy')
+        npG3D = self._compiled(self.spG3D)
 
         model = lmfit.Model(npG3D)
         params = lmfit.Parameters()
         for i, p in enumerate(self.params):
             params.add(str(p), value=self.init_params[i], min=self.bounds[i][0], max=self.bounds[i][1])
         
-        results = model.fit(ydata, params, x=xdata)
+        fit_kws = {}
+        if analytic_jac:
+            npjac = self._compiled_jacobian(self.spG3D)
+            def residual_jac(pars, data, weights, x):   # residual is data - model, (len(x), len(params))
+                jac = -npjac(x, *[pars[str(p)].value for p in self.params])
+                return (jac if weights is None else jac*weights).T
+            fit_kws = {'jac': residual_jac}
+        if method is None:
+            method = 'least_squares' if analytic_jac else 'leastsq'
+        results = model.fit(ydata, params, x=xdata, weights=weights, method=method, fit_kws=fit_kws)
+        self.nfev = results.nfev
         popt = [results.best_values[str(p)] for p in self.params]
         perr = [results.params[str(p)].stderr for p in self.params]
         self.fitted_params = popt
         self.fitted_params_err = list(map(lambda _: 0 if _ is None else _, perr))
 
         # residual computation
-        self.residual = np.sqrt(np.sum((npG3D(xdata, *popt) - ydata)**2))
-        self.rmse = self.residual / np.sqrt(len(ydata))
+        self.residual = np.sqrt(np.sum(w2 * (npG3D(xdata, *popt) - ydata)**2))
+        self.rmse = self.residual / np.sqrt(np.sum(w2))
 
         # chi2 computation
         eps = 1e-10
         denom = ydata
         denom = np.where(denom < eps, eps, denom)
-        self.chi2 = (npG3D(xdata, *popt) - ydata)**2 / denom
+        self.chi2 = w2 * (npG3D(xdata, *popt) - ydata)**2 / denom
         self.chi2 = np.sum(self.chi2)
-        self.stderr = np.sqrt(self.chi2 / (len(xdata) - len(self.params)))
+        self.stderr = np.sqrt(self.chi2 / (np.sum(w2) - len(self.params)))
 
         return self.residual, self.chi2
     
+    def _key(self):
+        return tuple(sorted(self.consts.items(), key=str)), tuple(self.params)
+
+    def _compiled(self, expr):
+        """expr(x, *params) compiled once per expression structure"""
+        return _compile(expr, *self._key())
+
+    def _compiled_jacobian(self, expr):
+        """Gradient of expr(x, *params) with respect to the fitted params, compiled once per expression structure"""
+        return _compile_jacobian(expr, *self._key())
+
+    def _with_params(self, expr):
+        func = self._compiled(expr)
+        values = list(self.get_params(redon=6, with_err=False).values())
+        return lambda r: func(r, *values)
+
+    def bootstrap(self, sample, n_replicas=200, rmin=0.0, n_knots=4096, workers=None, seed=None, progress=True):
+        """
+        Bootstrap uncertainties of the fitted parameters. The radial sample (in fit units) is fitted once, then
+        resampled with replacement n_replicas times and each replica is refitted in a process pool, starting 
+        from the nominal parameters. The sample is shared read-only with the workers (shared memory) and every
+        replica G3D is compressed to n_knots (see compress_G3D).
+        fitted_params are left at the nominal fit and fitted_params_err at the bootstrap standard deviation.
+
+        Returns:
+            dict: {'nominal', 'mean', 'std', 'p16', 'p84' (per parameter), 'replicas' (n_replicas x params)}
+        """
+        sample = np.sort(np.asarray(sample, dtype=np.float64))
+        s = len(sample)
+        r_knots, G3D_knots, weights, _ = compress_G3D(sample, (np.arange(1, s+1) - 0.5)/s, n_knots)
+        self.fit(r_knots, G3D_knots, rmin, weights=weights)
+        nominal = list(self.fitted_params)
+        state = (self.residual, self.chi2, self.rmse, self.stderr, self.nfev)
+
+        seeds = np.random.SeedSequence(seed).spawn(n_replicas)
+        shm = shared_memory.SharedMemory(create=True, size=sample.nbytes)
+        try:
+            np.ndarray(s, dtype=np.float64, buffer=shm.buf)[:] = sample
+            workers = workers or os.cpu_count()
+            with ProcessPoolExecutor(workers, initializer=_init_bootstrap, 
+                                     initargs=(shm.name, s, self, nominal, rmin, n_knots)) as pool:
+                replicas = list(tqdm(pool.map(_bootstrap_replica, seeds, chunksize=max(1, n_replicas//(4*workers))), 
+                                     total=n_replicas, disable=not progress))
+        finally:
+            shm.close()
+            shm.unlink()
+
+        replicas = np.array(replicas)
+        self.fitted_params = nominal
+        self.fitted_params_err = list(np.std(replicas, axis=0, ddof=1))
+        self.residual, self.chi2, self.rmse, self.stderr, self.nfev = state
+        names = list(map(str, self.params))
+        return {'nominal': dict(zip(names, nominal)), 
+                'mean': dict(zip(names, np.mean(replicas, axis=0))),
+                'std': dict(zip(names, self.fitted_params_err)),
+                'p16': dict(zip(names, np.percentile(replicas, 16, axis=0))),
+                'p84': dict(zip(names, np.percentile(replicas, 84, axis=0))),
+                'replicas': replicas}
+
     def get_params(self, redon=2, with_err=True):
         params_rounded = [round(p, redon) for p in self.fitted_params]
         if with_err:
@@ -84,22 +210,13 @@ class FitG3D:
         print() 
     
     def get_G3D(self):
-        all_params = {**self.consts, **self.get_params(redon=6, with_err=False)}
-        G3D = self.spG3D.subs(all_params)
-        G3D = sp.lambdify(x, G3D, 'numpy')
-        return G3D
+        return self._with_params(self.spG3D)
 
     def get_g3D(self):
-        all_params = {**self.consts, **self.get_params(redon=6, with_err=False)}
-        g3D = self.spg3D.subs(all_params)
-        g3D = sp.lambdify(x, g3D, 'numpy')
-        return g3D
+        return self._with_params(self.spg3D)
     
     def get_aPSF3D(self):
-        all_params = {**self.consts, **self.get_params(redon=6, with_err=False)}
-        aPSF3D = self.spaPSF3D.subs(all_params)
-        aPSF3D = sp.lambdify(x, aPSF3D, 'numpy')
-        return aPSF3D
+        return self._with_params(self.spaPSF3D)
     
 def MBfit_function(*weights, n_is_const=False):
     """
@@ -134,16 +251,38 @@ def MBfit_function(*weights, n_is_const=False):
     fit_func = FitG3D(spf, const, params, str(spf))
     return fit_func, argsP, argsC
 
+def benchmark_jacobian(fit_func:FitG3D, xdata, ydata, rmin=0.0, repeats=3):
+    """
+    Compares the fit with the analytic Jacobian against finite differences with the same optimiser
+    (least_squares) and against the finite differences leastsq path.
+    Returns:
+        dict: {path: (model evaluations, best wall time in s, chi2)}
+    """
+    import time
+    fit_func.fit(xdata, ydata, rmin, analytic_jac=True)    # compile before timing
+    bench = {}
+    for analytic_jac, method in ((True, 'least_squares'), (False, 'least_squares'), (False, 'leastsq')):
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            fit_func.fit(xdata, ydata, rmin, analytic_jac=analytic_jac, method=method)
+            times.append(time.perf_counter() - t0)
+        name = f"{method} {'analytic' if analytic_jac else 'numeric'}"
+        bench[name] = (fit_func.nfev, min(times), fit_func.chi2)
+        print(f"{name:22}: {fit_func.nfev} evaluations, {min(times):.3f} s, chi2 = {fit_func.chi2:.4e}")
+    return bench
+
 ############################################################################################################
-def load_sample(input_file):
-    sample = np.loadtxt(input_file)
-    if sample.ndim == 1:
-        pass
-    elif sample.ndim == 2:
-        sample = np.sqrt(np.sum(sample**2, axis=1))
-    else:
-        print("Invalid input file")
-    return sample
+def load_sample(input_file, chunk_size=int(1e6)):
+    """Loads the radial distances of a sample of radii (1 column) or xyz coords (3 columns),
+    parsing chunk_size rows at a time so only the radii of the whole sample are kept"""
+    sample = []
+    for data in iter_coords(input_file, chunk_size):
+        if data.shape[1] == 1:
+            sample.append(data[:, 0])
+        else:
+            sample.append(np.sqrt(np.sum(data**2, axis=1)))
+    return np.concatenate(sample)
     
 ############################################################################################################
 def load_nonhisto_G3D(input_file):
@@ -154,10 +293,95 @@ def load_nonhisto_G3D(input_file):
     G3D_sort = (np.arange(1,s+1) - 0.5)/s
     return sample_sorted, G3D_sort
 
-def load_nonhisto_g3D(input_file, tol=1e-6):    # default tol in cm
+def compress_G3D(sample_sorted, G3D_sort, n_knots=4096):
+    """
+    Reduces the empirical G3D to n_knots quantile knots (equally spaced in G3D).
+    Each knot stands for the sample points closest to it in rank, so fitting the knots with weights 
+    sqrt(counts) approximates the residual of the whole sample.
+    Returns:
+        r_knots, G3D_knots, weights, max_err: max_err bounds the difference between the full empirical G3D 
+        and the linear interpolation of the knots (largest G3D gap between consecutive knots)
+    """
+    s = len(sample_sorted)
+    if s <= n_knots:
+        return sample_sorted, G3D_sort, np.ones(s), 0.0
+    idx = np.unique(np.round(np.linspace(0, s-1, n_knots)).astype(np.int64))
+    edges = np.concatenate(([0], (idx[:-1] + idx[1:])//2 + 1, [s]))
+    counts = np.diff(edges)
+    return sample_sorted[idx], G3D_sort[idx], np.sqrt(counts), float(np.max(np.diff(G3D_sort[idx])))
+
+def load_compressed_G3D(input_file, n_knots=4096):
+    """load_nonhisto_G3D reduced to n_knots quantile knots (see compress_G3D)"""
+    return compress_G3D(*load_nonhisto_G3D(input_file), n_knots)
+
+def compression_drift(fit_func:FitG3D, sample_r, sample_G3D, n_knots=4096, rmin=0.0, atol=1e-3):
+    """
+    Fits the full empirical G3D and its compressed version and compares both fits.
+    The drift of each parameter is measured in units of max(standard error of the full fit, atol): parameters
+    left undetermined by the sample (e.g. b1 near its 0 bound, with a standard error much larger than its value)
+    may move freely, and atol is the floor of well determined ones (the precision of the stored fits).
+    The fitted curves are compared by their max. G3D difference over the sample (the fitted parameters are 
+    correlated, so the curves can agree while parameters move).
+    Returns:
+        dict: {'drift': drift per parameter in max(std. error, atol) units, 'max_dG3D': max. |G3D_knots - G3D_full|,
+               'max_err': G3D bound of the knots, 'time_full'/'time_knots': fit wall times in s}
+    """
+    import time
+    init_params = list(fit_func.init_params)
+    t0 = time.perf_counter()
+    fit_func.fit(sample_r, sample_G3D, rmin)
+    time_full = time.perf_counter() - t0
+    full, full_err = np.array(fit_func.fitted_params), np.array(fit_func.fitted_params_err)
+
+    r_knots, G3D_knots, weights, max_err = compress_G3D(sample_r, sample_G3D, n_knots)
+    fit_func.init_params = init_params
+    t0 = time.perf_counter()
+    fit_func.fit(r_knots, G3D_knots, rmin, weights=weights)
+    time_knots = time.perf_counter() - t0
+    knots = np.array(fit_func.fitted_params)
+
+    drift = np.abs(knots - full) / np.maximum(full_err, atol)
+    npG3D = fit_func._compiled(fit_func.spG3D)
+    r = sample_r[sample_r > rmin]
+    max_dG3D = float(np.max(np.abs(npG3D(r, *knots) - npG3D(r, *full))))
+    print(f"{len(sample_r)} points -> {len(r_knots)} knots (max. G3D error {max_err:.1e}): "
+          f"fit {time_full:.3f} s -> {time_knots:.3f} s, max. G3D difference {max_dG3D:.1e}, "
+          f"max. parameter drift {drift.max():.1e} std. errors")
+    return {'drift': dict(zip(map(str, fit_func.params), drift)), 'max_dG3D': max_dG3D, 'max_err': max_err, 
+            'time_full': time_full, 'time_knots': time_knots}
+
+def check_compression(fit_func:FitG3D, sample_r, sample_G3D, n_knots=4096, rmin=0.0, tol_G3D=1e-3, tol_drift=1.0, atol=1e-3):
+    """
+    Checks that fitting the compressed G3D gives the fit of the full sample (see compression_drift):
+    the fitted curves differ less than tol_G3D and every parameter drifts less than tol_drift.
+    Returns:
+        (bool, dict): True if the compression passes, and the compression_drift results
+    """
+    results = compression_drift(fit_func, sample_r, sample_G3D, n_knots, rmin, atol)
+    passed = results['max_dG3D'] < tol_G3D and max(results['drift'].values()) < tol_drift
+    return passed, results
+
+def load_nonhisto_g3D(input_file, tol=1e-6, max_knots=2**16):    # default tol in cm
+    """
+    g3D as the derivative of the interpolated empirical G3D over bins of width tol. 
+    If rmax/tol exceeds max_knots, only max_knots bin edges are kept (memory does not grow with rmax/tol): 
+    half follow the quantiles of the sample and half are uniform in r, all rounded to the tol grid.
+    The bins are then not the tol bins: each one spans about len(sample)/(max_knots/2) samples where the sample 
+    is dense (several tol bins if the sample has more than max_knots/2 points) and about rmax/(max_knots/2) 
+    in the sparse tails. The output then differs from the plain tol bins at the same tol (e.g. by ~12% for a
+    3e5 points sample at the default tol, as the peak used to normalise is smoothed); raise max_knots to 
+    approach them. With rmax/tol <= max_knots the tol bins are used as they are.
+    """
     sample_sorted, G3D_sort = load_nonhisto_G3D(input_file)
 
-    thin_sample = np.arange(0, sample_sorted[-1], tol)
+    nbins = int(np.ceil(sample_sorted[-1] / tol))   # grid points of np.arange(0, rmax, tol)
+    if nbins <= max_knots:
+        knots = np.arange(nbins)
+    else:
+        quantiles = sample_sorted[np.linspace(0, len(sample_sorted)-1, max_knots//2).astype(np.int64)]
+        knots = np.concatenate((np.round(quantiles / tol), np.linspace(0, nbins-1, max_knots//2).round()))
+        knots = np.unique(np.clip(knots, 0, nbins-1)).astype(np.int64)
+    thin_sample = knots * tol
     thin_G3D = np.interp(thin_sample, sample_sorted, G3D_sort)
     rp = thin_sample[:-1] + np.diff(thin_sample)/2  # mid points
 
@@ -168,8 +392,8 @@ def load_nonhisto_g3D(input_file, tol=1e-6):    # default tol in cm
     g3D_sort = g3D_sort / g3D_sort.max()
     return rp, g3D_sort
 
-def load_nonhisto_aPSF3D(input_file, tol=1e-6):
-    rp, g3D_sort = load_nonhisto_g3D(input_file, tol)
+def load_nonhisto_aPSF3D(input_file, tol=1e-6, max_knots=2**16):
+    rp, g3D_sort = load_nonhisto_g3D(input_file, tol, max_knots)
     aPSF3D_sort = g3D_sort / rp**2
     aPSF3D_sort = aPSF3D_sort / aPSF3D_sort.max()
     return rp, aPSF3D_sort
@@ -197,7 +421,7 @@ def load_histo_G3D(input_file, bin_size=0.5):
     return rp, G3D
 
 ############################################################################################################
-from betaplus import MB, SB, Fermi_factor, shape_factor
+from betaplus import MB, SB, Fermi_table, shape_factor
 def halflife_values(iso):
     match iso:
         case "C11":   hl = 20.3 * 60  # Convert minutes to seconds
@@ -223,7 +447,7 @@ def coulomb_effect(iso, branch=0):
         raise ValueError(f"Undefined isotope: {iso}")
     
     ee = np.linspace(1e-10, Em, 100)
-    ff = Fermi_factor(Z, ee)
+    ff = Fermi_table(Z, ee)
     nc = (N-Z)**2/A * np.mean(ff)
     return [1+nc]
     # return [max(N/Z, N/Z + (N-Z)/(N+Z))]
@@ -236,4 +460,110 @@ def coulomb_effect(iso, branch=0):
     # R = 1.26*(A)**(1/3)
     # RZ = 1.26*(Z)**(1/3)
     # hc = 197.327
-    # return [1 + Z/N * Em*R/hc]
\ No newline at end of file
+    # return [1 + Z/N * Em*R/hc]
+############################################################################################################
+import csv
+
+def sb_model(iso):
+    """Single-branch fitting function (study5) for any isotope"""
+    return MBfit_function(100)
+
+def _subdirs(path):
+    return sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+
+def walk_results(results_dir="RESULTS", cases=None, materials=None, codes=None):
+    """
+    Yields (case, material, code, folder) for every results_dir/<case>/<material>/<code>_xyz folder, sorted.
+    cases, materials, codes: optional lists to restrict the walk (codes without the _xyz suffix)
+    """
+    for case in _subdirs(results_dir):
+        if cases and case not in cases: continue
+        for material in _subdirs(os.path.join(results_dir, case)):
+            if materials and material not in materials: continue
+            for cfolder in _subdirs(os.path.join(results_dir, case, material)):
+                code = cfolder.removesuffix("_xyz")
+                if not cfolder.endswith("_xyz") or (codes and code not in codes): continue
+                yield case, material, code, os.path.join(results_dir, case, material, cfolder)
+
+def find_samples(results_dir="RESULTS", cases=None, materials=None, codes=None):
+    """
+    Walks results_dir/<case>/<material>/<code>_xyz/<isotope>.dat|bin (a .bin is used instead of its .dat).
+    cases, materials, codes: optional lists to restrict the walk (see walk_results)
+    Returns:
+        list[dict]: {'case', 'material', 'code', 'isotope', 'file'} sorted by case, code, material, isotope
+    """
+    samples = []
+    for case, material, code, folder in walk_results(results_dir, cases, materials, codes):
+        files = {}
+        for name in sorted(os.listdir(folder)):
+            stem, ext = os.path.splitext(name)
+            if ext not in ('.dat', '.bin') or '_times' in stem or '_fit' in stem: continue
+            if ext == '.bin' or stem not in files:
+                files[stem] = os.path.join(folder, name)
+        samples += [{'case': case, 'material': material, 'code': code, 'isotope': iso, 'file': file} 
+                    for iso, file in files.items()]
+    return sorted(samples, key=lambda s: (s['case'], s['code'], s['material'], s['isotope']))
+
+def _fit_chain(jobs, model, rmin, starts):
+    """Fits a list of samples in order, warm-starting each fit from the best parameters of the previous fit 
+    of the same isotope (other material) or, if missing, of the previous isotope of the same material"""
+    rows = []
+    best = {}   # (material or isotope) -> (params names, fitted params)
+    for job in jobs:
+        fit_func, argsP, argsC = model(job['isotope'])
+        names = [str(p) for p in argsP]
+        sample_r, sample_G3D = load_nonhisto_G3D(job['file'])
+        sample_r *= 10  # cm -> mm
+
+        warm = [best[k][1] for k in (('iso', job['isotope']), ('mat', job['material'])) if k in best and best[k][0] == names]
+        inits = warm[:1] or [[i0]*len(argsP) for i0 in starts]
+        min_res = (np.inf, None)
+        for init in inits:
+            fit_func.init_params = list(init)
+            res, chi2 = fit_func.fit(sample_r, sample_G3D, rmin=rmin)
+            if res < min_res[0]:
+                min_res = (res, fit_func.fitted_params, fit_func.rmse, chi2, fit_func.nfev)
+        res, params, rmse, chi2, nfev = min_res
+        best[('iso', job['isotope'])] = best[('mat', job['material'])] = (names, params)
+
+        rows.append({**{k: job[k] for k in ('case', 'material', 'code', 'isotope')}, 
+                     'residue': res, 'rmse': rmse, 'chi2': chi2, 'nfev': nfev, 'warm_start': bool(warm), 
+                     'function': fit_func.name, **dict(zip(names, params))})
+    return rows
+
+def batch_fit(samples:list[dict], save_file=None, model=sb_model, rmin=5e-2, starts=(0, 0.8, 1.6), 
+              workers=None, progress=True):
+    """
+    Fits the G3D of many samples (see find_samples) in parallel processes and writes one results table.
+    Samples of the same case and code form a chain fitted in one process, materials and isotopes in order,
+    so each fit starts from the best parameters of a neighbouring isotope/material. Fits without a 
+    neighbour try every value in starts for all parameters (as in study5) and keep the lowest residue.
+
+    Parameters:
+        samples (list): {'case', 'material', 'code', 'isotope', 'file'} dicts
+        save_file (str): Output table (csv), one row per sample. Not written if None
+        model (function): isotope -> (FitG3D, argsP, argsC), e.g. sb_model (must be picklable, i.e. module-level)
+        rmin (float): Minimum radius fitted in mm
+        starts (tuple): Initial values of the cold starts
+        workers (int): Number of processes (all cpus by default)
+    Returns:
+        list[dict]: Rows of the table (case, material, code, isotope, residue, rmse, chi2, nfev, warm_start, function, params)
+    """
+    chains = {}
+    for sample in samples:
+        chains.setdefault((sample['case'], sample['code']), []).append(sample)
+
+    rows = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_fit_chain, jobs, model, rmin, tuple(starts)): key for key, jobs in chains.items()}
+        for future in tqdm(as_completed(futures), total=len(futures), disable=not progress):
+            rows[futures[future]] = future.result()
+    rows = [row for key in chains for row in rows[key]]    # keep the order of the samples
+
+    if save_file:
+        fields = list(dict.fromkeys(k for row in rows for k in row))
+        with open(save_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
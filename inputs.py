@@ -1,6 +1,7 @@
 import numpy as np
 import subprocess
 import simuls as Simulators
+from betaplus import write_spectrum
 
 class InputEditor:
     def __init__(self, verbose=True):
@@ -216,6 +217,12 @@ class PenEasy(InputEditor):
         if self.verbose: 
             print(f"\"penEasy/phantom.vox\" updated to {shape} source with activity {ACT}")
 
+    def edit_spectrum(self, E, N):
+        """Writes the emission spectrum (E in keV) to penEasy/pnnc_spec.dat (pid SPC), only if it changed"""
+        written = write_spectrum(E, N, 'penEasy/pnnc_spec.dat', 'penEasy')
+        if self.verbose:
+            print(f"\"penEasy/pnnc_spec.dat\" {'updated' if written else 'unchanged'}")
+
     def edit_source_nhist(self, pid:str, nhist:str):
         current_size, current_step = self._get_voxData(pid)
         with open("penEasy/mat/ACTIVITY.raw", 'rb') as f:
@@ -1,28 +1,146 @@
-import numpy as np
+import os
+import json
+import hashlib
 import itertools
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from scipy.integrate import cumulative_trapezoid
 
-def VG(dist_aPSF3D, STEP, SIZE, rlim, voxel_griding=5, source_griding=3, disable_tqdm=False):
+class RadialLUT:
     """
-    Performs voxel gridding (VG) to compute a 3D PSF kernel.
+    aPSF3D(r) tabulated once on a fine log-spaced radial grid and evaluated by linear interpolation
+    (in log-log if it is positive, as it behaves as a power of r near 0), so its cost does not depend on how expensive dist_aPSF3D is (e.g. lambdified fits).
+    Also tabulates the cumulative integral G3D(r) = int_rmin^r 4pi r'^2 aPSF3D(r') dr' (unnormalized).
+    """
+    def __init__(self, dist_aPSF3D, rlim, n_points=int(2**14)):
+        rmin, rmax = rlim
+        self.logr = np.linspace(np.log(rmin), np.log(rmax), n_points)
+        self.dlogr = self.logr[1] - self.logr[0]
+        self.r = np.exp(self.logr)
+        self.psf = np.asarray(dist_aPSF3D(self.r), dtype=np.float64) * np.ones_like(self.r)
+        self.G3D = cumulative_trapezoid(4*np.pi * self.r**2 * self.psf, self.r, initial=0)
+        self.loglog = np.all(self.psf > 0)
+        self.table = np.log(self.psf) if self.loglog else self.psf
+
+    def __call__(self, r):
+        t = (np.log(np.maximum(r, self.r[0])) - self.logr[0]) / self.dlogr
+        i = np.clip(t.astype(np.intp), 0, len(self.r)-2)
+        w = np.clip(t - i, 0, 1)
+        psf = self.table[i]*(1-w) + self.table[i+1]*w
+        return np.exp(psf) if self.loglog else psf
+
+    def cumulative(self, r):
+        """Interpolates the tabulated cumulative integral G3D(r)"""
+        return np.interp(r, self.r, self.G3D)
+
+    def error(self, dist_aPSF3D):
+        """Compares the table with dist_aPSF3D on the (geometric) midpoints of the grid"""
+        rmid = np.exp(self.logr[:-1] + self.dlogr/2)
+        direct = np.asarray(dist_aPSF3D(rmid), dtype=np.float64) * np.ones_like(rmid)
+        diff = np.abs(self(rmid) - direct)
+        weights = 4*np.pi * rmid**2 * np.diff(self.r)   # volume of each radial shell
+        return {'max_abs': diff.max(),
+                'max_rel': (diff / np.maximum(np.abs(direct), np.finfo(float).tiny)).max(),
+                'integral_rel': np.sum(diff*weights) / np.sum(np.abs(direct)*weights)}
+
+def _axis_offsets(step, n, voxel_griding, source_griding):
+    """
+    Per-axis differences between the sub-samples of every kernel voxel and the sub-samples of the source voxel.
+
+    Returns:
+        numpy.ndarray: (n, voxel_griding*source_griding) array, row i holds (x - sx) for voxel i
+    """
+    centers = (np.arange(n) - n//2)*step
+    grid_voxel = np.linspace(centers - step/2, centers + step/2, voxel_griding)                    # (voxel_griding, n)
+    grid_source = np.linspace(0, step/2, 1+source_griding//2)                                       # Only positive to always start at 0
+    grid_source = np.sort(np.concat((-grid_source[1:], +grid_source), dtype=np.float32))          # Include negative values
+    offsets = grid_voxel[:, :, None] - grid_source[None, None, :]                                   # (voxel_griding, n, source_griding)
+    return offsets.transpose(1, 0, 2).reshape(n, -1)
+
+def _eval_voxels(dist_aPSF3D, offsets, voxels, rlim, max_elems=int(2**24), disable_tqdm=True):
+    """
+    Integrates dist_aPSF3D over the sub-samples of the given kernel voxels in batches of at most max_elems distances.
+    If a single voxel has more than max_elems sub-sample distances (fine griding), its x, y (and z) sub-samples
+    are split into slices and the partial sums are added up.
 
     Parameters:
-        dist_aPSF3D (function): Function that calculates the PSF value given a distance r
-        STEP (list): Voxel dimensions in cm [dx, dy, dz] in mm
-        SIZE (list): Kernel size in voxels [nx, ny, nz]
+        dist_aPSF3D (function): Function that calculates the PSF value given a distance r (vectorized)
+        offsets (list): Per-axis offsets from _axis_offsets
+        voxels (numpy.ndarray): (N, 3) kernel voxel indices
         rlim (tuple): (rmin, rmax) Range of distances to consider in mm
-        voxel_griding (int): Number of samples within each voxel
-        source_griding (int): Number of samples within the source voxel
+        max_elems (int): Maximum number of distances evaluated at once (bounds memory)
 
     Returns:
-        numpy.ndarray: Normalized 3D PSF kernel
+        numpy.ndarray: (N,) sum of the PSF over the sub-samples of each voxel
     """
-    if voxel_griding % 2 == 0:
-        voxel_griding += 1  # Ensure voxel_griding is odd
-        print("voxel_griding is changed to", voxel_griding)
-    if source_griding % 2 == 0:
-        source_griding += 1
-        print("source_griding is changed to", source_griding)
+    rmin, rmax = rlim
+    offx, offy, offz = offsets
+    nx, ny, nz = offx.shape[1], offy.shape[1], offz.shape[1]
+    batch = max(1, max_elems // (nx*ny*nz))
+    # sub-sample slices per voxel (whole axes unless one voxel alone exceeds max_elems)
+    sz = min(nz, max_elems)
+    sy = min(ny, max(1, max_elems // sz))
+    sx = min(nx, max(1, max_elems // (sy*sz)))
+    slices = list(itertools.product(range(0, nx, sx), range(0, ny, sy), range(0, nz, sz)))
+    values = np.zeros(len(voxels))
+    for b in tqdm(range(0, len(voxels), batch), disable=disable_tqdm):
+        ix, iy, iz = voxels[b:b+batch].T
+        x, y, z = offx[ix], offy[iy], offz[iz]
+        for i, j, k in slices:
+            xs, ys, zs = x[:, i:i+sx], y[:, j:j+sy], z[:, k:k+sz]
+            r = np.sqrt(xs[:, :, None, None]**2 + ys[:, None, :, None]**2 + zs[:, None, None, :]**2)
+            mask = (r >= rmin) & (r <= rmax)
+            psf = np.where(mask, dist_aPSF3D(r), 0)    # masked r (e.g. r=0) may give inf/nan
+            values[b:b+batch] += psf.sum(axis=(1, 2, 3))
+    return values
+
+_worker_args = dict()   # arguments of _eval_voxels shared by the voxel shards of a worker process
+
+def _init_worker(dist_aPSF3D, offsets, rlim, max_elems):
+    _worker_args.update(dist_aPSF3D=dist_aPSF3D, offsets=offsets, rlim=rlim, max_elems=max_elems)
+
+def _eval_shard(voxels):
+    return _eval_voxels(voxels=voxels, **_worker_args)
+
+def _eval_voxels_parallel(dist_aPSF3D, offsets, voxels, rlim, max_elems=int(2**24), disable_tqdm=True, workers=None):
+    """
+    Same as _eval_voxels, sharding the voxels across a pool of worker processes (each holding up to max_elems distances).
+    Workers are forked when possible, so dist_aPSF3D does not need to be picklable (e.g. lambdified functions).
+    """
+    workers = workers or os.cpu_count()
+    shards = np.array_split(voxels, min(len(voxels), 4*workers))
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, 
+                             initargs=(dist_aPSF3D, offsets, rlim, max_elems)) as pool:
+        values = list(tqdm(pool.map(_eval_shard, shards), total=len(shards), disable=disable_tqdm))
+    return np.concatenate(values)
+
+def _unique_voxels(SIZE, permutable):
+    """
+    Voxels of the kernel octant with non-negative coords (indices relative to the source voxel),
+    and only those with ix >= iy >= iz if the kernel is also symmetric under axes permutations.
+    """
+    octant = np.indices([n//2+1 for n in SIZE]).reshape(3, -1).T
+    if permutable:
+        octant = octant[(octant[:, 0] >= octant[:, 1]) & (octant[:, 1] >= octant[:, 2])]
+    return octant
+
+def _reflect_octant(values, voxels, SIZE, permutable):
+    """Builds the full kernel from the values of the unique voxels of its octant"""
+    octant = np.zeros([n//2+1 for n in SIZE])
+    perms = itertools.permutations(range(3)) if permutable else [(0, 1, 2)]
+    for perm in perms:
+        octant[tuple(voxels[:, perm].T)] = values
+    
+    kernel = octant
+    for axis in range(3):   # mirror each axis through the source voxel
+        kernel = np.concatenate((np.flip(np.delete(kernel, 0, axis), axis), kernel), axis)
+    return kernel
+
+def _check_kernel_args(STEP, SIZE, rlim):
+    """Checks the kernel geometry and returns STEP in mm and the (rmin, rmax) distances considered"""
     if len(STEP) != 3 or len(SIZE) != 3:
         raise ValueError("STEP and SIZE must be lists of length 3.")
     if len(rlim) != 2:
@@ -35,34 +153,228 @@ def VG(dist_aPSF3D, STEP, SIZE, rlim, voxel_griding=5, source_griding=3, disable
     RMAX = 3**0.5 * max(STEP)*max(SIZE)/2
     rmax = RMAX if rmax is None or rmax > RMAX else rmax    # Ensure rmax is within reasonable bounds
 
-    dx, dy, dz = STEP
     nx, ny, nz = SIZE
-    aPSF_kernel = np.zeros((nx, ny, nz), dtype=np.float32)
 
     # Check size is odd
     if nx % 2 == 0 or ny % 2 == 0 or nz % 2 == 0:
         raise ValueError("Kernel sizes must be odd to properly place the source voxel.")
+    return STEP, rmin, rmax
 
-    # Load iterators to save memory
-    voxel_indices = ((ix, iy, iz) for ix in range(nx) for iy in range(ny) for iz in range(nz))
-    auxiliary_indices = ((ix, iy, iz) for ix in range(nx) for iy in range(ny) for iz in range(nz))
-    voxel_centers = (((ix-nx//2)*dx, (iy-ny//2)*dy, (iz-nz//2)*dz) for ix, iy, iz in auxiliary_indices)
+def VG(dist_aPSF3D, STEP, SIZE, rlim, voxel_griding=5, source_griding=3, disable_tqdm=False, max_elems=int(2**24), 
+       symmetry=True, lut_points=None, workers=1):
+    """
+    Performs voxel gridding (VG) to compute a 3D PSF kernel.
+    Distances are evaluated in vectorized batches of kernel voxels and all their voxel/source sub-samples.
+    As the PSF only depends on r, the kernel is mirror-symmetric in x, y and z (and symmetric under axes 
+    permutations if SIZE and STEP are isotropic), so only the unique voxels of one octant are evaluated.
 
-    # Grid points in source voxel
-    grid_source = [np.linspace(0, step/2, 1+source_griding//2) for step in STEP]  # Only positive to always start at 0
-    grid_source = [np.sort(np.concat((-g[1:], +g), dtype=np.float32)) for g in grid_source]         # Include negative values
+    Parameters:
+        dist_aPSF3D (function): Function that calculates the PSF value given a distance r (vectorized)
+        STEP (list): Voxel dimensions in cm [dx, dy, dz] in mm
+        SIZE (list): Kernel size in voxels [nx, ny, nz]
+        rlim (tuple): (rmin, rmax) Range of distances to consider in mm
+        voxel_griding (int): Number of samples within each voxel
+        source_griding (int): Number of samples within the source voxel
+        max_elems (int): Maximum number of distances evaluated at once (bounds memory)
+        symmetry (bool): Evaluate only the unique voxels and reflect them (False evaluates every voxel)
+        lut_points (int): If given, dist_aPSF3D is tabulated on lut_points radii (RadialLUT) and interpolated
+        workers (int): Number of processes the kernel voxels are sharded across (None for all cpus)
+
+    Returns:
+        numpy.ndarray: Normalized 3D PSF kernel
+    """
+    if voxel_griding % 2 == 0:
+        voxel_griding += 1  # Ensure voxel_griding is odd
+        print("voxel_griding is changed to", voxel_griding)
+    if source_griding % 2 == 0:
+        source_griding += 1
+        print("source_griding is changed to", source_griding)
+    STEP, rmin, rmax = _check_kernel_args(STEP, SIZE, rlim)
 
-    # Loop over all voxels in kernel and grid them
-    for (ix,iy,iz), (cx,cy,cz) in tqdm(zip(voxel_indices, voxel_centers), total=nx*ny*nz//2, disable=disable_tqdm):
-      grid_xyz = np.linspace((cx-dx/2, cy-dy/2, cz-dz/2), (cx+dx/2, cy+dy/2, cz+dz/2), voxel_griding)
-      x,y,z = np.meshgrid(grid_xyz[:, 0], grid_xyz[:, 1], grid_xyz[:, 2], indexing='ij')
+    # Tabulate aPSF3D(r) once
+    if lut_points:
+        lut = RadialLUT(dist_aPSF3D, (rmin, rmax), lut_points)
+        err = lut.error(dist_aPSF3D)
+        print(f"LUT error: max. abs. {err['max_abs']:.3e}, max. rel. {err['max_rel']:.3e}, integral rel. {err['integral_rel']:.3e}")
+        dist_aPSF3D = lut
 
-      # Loop over all sampled source points and eval aPSF3D(r)
-      for (sx, sy, sz) in itertools.product(*grid_source):
-        r = np.sqrt((x-sx)**2 + (y-sy)**2 + (z-sz)**2)
-        mask = (r >= rmin) & (r <= rmax)
-        psf = dist_aPSF3D(r) * mask
-        aPSF_kernel[ix, iy, iz] += psf.sum()
+    # Grid all voxels in kernel (and the source voxel) along each axis
+    offsets = [_axis_offsets(step, n, voxel_griding, source_griding) for step, n in zip(STEP, SIZE)]
+
+    # Eval aPSF3D(r) over all (unique) voxels in kernel
+    evaluate = _eval_voxels if workers == 1 else lambda *args: _eval_voxels_parallel(*args, workers=workers)
+    if symmetry:
+        permutable = len(set(SIZE)) == 1 and len(set(STEP)) == 1
+        voxels = _unique_voxels(SIZE, permutable)
+        values = evaluate(dist_aPSF3D, offsets, voxels + np.array(SIZE)//2, (rmin, rmax), max_elems, disable_tqdm)
+        aPSF_kernel = _reflect_octant(values, voxels, SIZE, permutable)
+    else:
+        voxels = np.indices(SIZE).reshape(3, -1).T
+        aPSF_kernel = evaluate(dist_aPSF3D, offsets, voxels, (rmin, rmax), max_elems, disable_tqdm)
+        aPSF_kernel = aPSF_kernel.reshape(SIZE)
 
     aPSF_kernel /= aPSF_kernel.sum()    
-    return aPSF_kernel
\ No newline at end of file
+    return aPSF_kernel.astype(np.float32)
+
+
+def _gauss_boxes(dist_aPSF3D, lo, hi, centers, STEP, rlim, order, max_elems=int(2**24)):
+    """
+    Tensor Gauss-Legendre integral of aPSF3D(|d|) over boxes [lo, hi] of the voxel-source difference d = v - s.
+    The difference of two uniform points in voxels of size h centred at c and 0 follows, along each axis,
+    the tent density (h - |d - c|)/h^2 on [c - h, c + h], which is linear inside each box.
+
+    Returns:
+        numpy.ndarray: (B,) integral over each box
+    """
+    rmin, rmax = rlim
+    xg, wg = np.polynomial.legendre.leggauss(order)
+    integrals = np.zeros(len(lo))
+    batch = max(1, max_elems // order**3)
+    for b in range(0, len(lo), batch):
+        nodes, weights = [], []
+        for a, h in enumerate(STEP):
+            half = (hi[b:b+batch, a] - lo[b:b+batch, a])[:, None]/2
+            d = (lo[b:b+batch, a][:, None] + half) + half*xg                # (batch, order)
+            nodes.append(d)
+            weights.append(half*wg * (h - np.abs(d - centers[b:b+batch, a][:, None]))/h**2)
+        x, y, z = nodes
+        r = np.sqrt(x[:, :, None, None]**2 + y[:, None, :, None]**2 + z[:, None, None, :]**2)
+        psf = np.where((r >= rmin) & (r <= rmax), dist_aPSF3D(r), 0)
+        integrals[b:b+batch] = np.einsum('bijk,bi,bj,bk->b', psf, *weights)
+    return integrals
+
+def AQ(dist_aPSF3D, STEP, SIZE, rlim, tol=1e-4, order=3, max_depth=12, max_elems=int(2**24), 
+       lut_points=None, verbose=False):
+    """
+    Computes a 3D PSF kernel by adaptive quadrature (AQ), an alternative to the uniform sub-sampling of VG.
+    Each voxel integral over the source and kernel voxels is reduced to a 3D integral of aPSF3D(|d|) weighted 
+    by the tent density of the difference d. Boxes of d are integrated with Gauss-Legendre rules of order and 
+    order+2 and bisected until both agree within tol*max(kernel), so only boxes where the PSF varies fast 
+    (e.g. near r=0) are refined. Only the unique voxels are evaluated (see VG).
+
+    Parameters:
+        dist_aPSF3D (function): Function that calculates the PSF value given a distance r (vectorized)
+        STEP (list): Voxel dimensions in cm [dx, dy, dz]
+        SIZE (list): Kernel size in voxels [nx, ny, nz]
+        rlim (tuple): (rmin, rmax) Range of distances to consider in mm
+        tol (float): Tolerance relative to the maximum of the (unnormalized) kernel
+        order (int): Order of the low Gauss-Legendre rule
+        max_depth (int): Maximum number of bisections of a box
+        max_elems (int): Maximum number of distances evaluated at once (bounds memory)
+        lut_points (int): If given, dist_aPSF3D is tabulated on lut_points radii (RadialLUT) and interpolated
+        verbose (bool): Print the number of PSF evaluations and boxes
+
+    Returns:
+        numpy.ndarray: Normalized 3D PSF kernel
+    """
+    STEP, rmin, rmax = _check_kernel_args(STEP, SIZE, rlim)
+    if lut_points:
+        dist_aPSF3D = RadialLUT(dist_aPSF3D, (rmin, rmax), lut_points)
+
+    permutable = len(set(SIZE)) == 1 and len(set(STEP)) == 1
+    voxels = _unique_voxels(SIZE, permutable)
+    centers = voxels * np.array(STEP)
+
+    # Initial boxes: each tent split at its peak
+    vox, lo, hi = [], [], []
+    for corner in itertools.product((0, 1), repeat=3):
+        corner = np.array(corner, dtype=bool)
+        vox.append(np.arange(len(voxels)))
+        lo.append(np.where(corner, centers, centers - STEP))
+        hi.append(np.where(corner, centers + STEP, centers))
+    vox, lo, hi = np.concatenate(vox), np.concatenate(lo), np.concatenate(hi)
+
+    values = np.zeros(len(voxels))
+    threshold = None
+    evals = nboxes = 0
+    for depth in range(max_depth+1):
+        q_lo = _gauss_boxes(dist_aPSF3D, lo, hi, centers[vox], STEP, (rmin, rmax), order, max_elems)
+        q_hi = _gauss_boxes(dist_aPSF3D, lo, hi, centers[vox], STEP, (rmin, rmax), order+2, max_elems)
+        evals += len(lo) * (order**3 + (order+2)**3)
+        if threshold is None:
+            threshold = tol * np.max(np.bincount(vox, q_hi, minlength=len(voxels)))
+
+        done = (np.abs(q_hi - q_lo) <= threshold) | (depth == max_depth)
+        values += np.bincount(vox[done], q_hi[done], minlength=len(voxels))
+        nboxes += np.sum(done)
+        vox, lo, hi = vox[~done], lo[~done], hi[~done]
+        if len(vox) == 0:
+            break
+
+        # Bisect the remaining boxes along every axis
+        mid = (lo + hi)/2
+        children = [(np.where(corner, mid, lo), np.where(corner, hi, mid)) 
+                    for corner in map(np.array, itertools.product((False, True), repeat=3))]
+        vox = np.tile(vox, 8)
+        lo = np.concatenate([child[0] for child in children])
+        hi = np.concatenate([child[1] for child in children])
+
+    if verbose:
+        print(f"AQ: {evals} PSF evaluations over {nboxes} boxes (max. depth {depth})")
+
+    aPSF_kernel = _reflect_octant(values, voxels, SIZE, permutable)
+    aPSF_kernel /= aPSF_kernel.sum()
+    return aPSF_kernel.astype(np.float32)
+
+class KernelBank:
+    """
+    Persistent bank of VG kernels, so an already computed kernel is read from disk instead of recomputed.
+    Kernels are keyed by isotope, material, a hash of the fitted parameters, SIZE, STEP, rlim and the gridding.
+    """
+    def __init__(self, bank_dir="kernels", verbose=False):
+        self.bank_dir = bank_dir
+        self.verbose = verbose
+        os.makedirs(bank_dir, exist_ok=True)
+
+    def _path(self, isotope:str, material:str, params, STEP, SIZE, rlim, voxel_griding, source_griding, lut_points):
+        key = {'isotope': isotope, 
+               'material': material, 
+               'params': hashlib.sha256(repr(params).encode('utf-8')).hexdigest()[:16],
+               'STEP': [float(s) for s in STEP], 
+               'SIZE': [int(n) for n in SIZE], 
+               'rlim': [None if r is None else float(r) for r in rlim],
+               'voxel_griding': voxel_griding, 
+               'source_griding': source_griding,
+               'lut_points': lut_points}
+        key_hash = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return f"{self.bank_dir}/{isotope}-{material}-{key_hash}.npz", key
+
+    def get(self, isotope:str, material:str, params, dist_aPSF3D, STEP, SIZE, rlim, 
+            voxel_griding=5, source_griding=3, lut_points=None, **VG_kwargs):
+        """
+        Returns the kernel from the bank, computing it with VG (and storing it) if it is not there.
+
+        Parameters:
+            isotope (str), material (str): Labels of the kernel
+            params: Fitted parameters of dist_aPSF3D (anything with a stable repr, e.g. FitG3D.get_params(with_err=False))
+            dist_aPSF3D, STEP, SIZE, rlim, voxel_griding, source_griding, lut_points: As in VG
+            VG_kwargs: Other VG arguments that do not change the kernel (disable_tqdm, max_elems, symmetry, workers)
+        """
+        path, key = self._path(isotope, material, params, STEP, SIZE, rlim, voxel_griding, source_griding, lut_points)
+        if os.path.exists(path):
+            if self.verbose:
+                print(f"{isotope} kernel in {material} read from {path}")
+            with np.load(path) as data:
+                return data['kernel']
+        
+        kernel = VG(dist_aPSF3D, STEP, SIZE, rlim, voxel_griding, source_griding, lut_points=lut_points, **VG_kwargs)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            np.savez(f, kernel=kernel, key=json.dumps(key))
+        os.replace(tmp, path)
+        if self.verbose:
+            print(f"{isotope} kernel in {material} saved to {path}")
+        return kernel
+
+    def get_many(self, jobs:list[dict], workers=None):
+        """Returns the kernels of several jobs (dicts of get arguments), sharding each missing one across workers processes"""
+        return [self.get(**{'workers': workers, **job}) for job in jobs]
+
+    def contents(self):
+        """Returns the keys of the kernels in the bank"""
+        keys = []
+        for f in sorted(os.listdir(self.bank_dir)):
+            if f.endswith('.npz'):
+                with np.load(f"{self.bank_dir}/{f}") as data:
+                    keys.append(json.loads(str(data['key'])))
+        return keys
@@ -1,7 +1,13 @@
+import os
+import shutil
+import tempfile
 import numpy as np
 import time
 import subprocess
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from annihilation import dat2bin
 
 class HostSimulator:
     active_simulators = dict()
@@ -16,11 +22,23 @@ class HostSimulator:
         t_real -= time.perf_counter()
         return out, err, abs(t_real), abs(t_cpu)
 
+    @staticmethod
+    def _final_file(guest, output_dir, final_file=None):
+        if not final_file:
+            return f"{output_dir}/{guest.pid}.{guest.output_format}"
+        elif "." not in final_file:
+            return f"{output_dir}/{final_file}.{guest.output_format}"  
+        return f"{output_dir}/{final_file}"
+
     def __init__(self, verbose=False):
         self.verbose = verbose
 
     @classmethod
-    def simulate(cls, pid:str, get_times:bool, time_samples=5, output_dir="RESULTS", final_file=None):
+    def simulate(cls, pid:str, get_times:bool, time_samples=5, output_dir="RESULTS", final_file=None, 
+                 binary=False, meta:dict=None, keep_ascii=False):
+        """binary: convert an ascii output into the binary annihilation container (see annihilation.py),
+        whose header stores meta = {isotope, material, seed, nhist} and the program name.
+        The ascii output is removed after the conversion unless keep_ascii"""
         # get simulator object
         if pid not in cls.active_simulators.keys():
             raise ValueError(f"Simulator with pid {pid} is not active")
@@ -36,12 +54,7 @@ class HostSimulator:
             subprocess.os.mkdir(output_dir)
 
         # get output file's name and format
-        if not final_file:
-            final_file = f"{output_dir}/{self.pid}.{self.output_format}"
-        elif "." not in final_file:
-            final_file = f"{output_dir}/{final_file}.{self.output_format}"  
-        else:
-            final_file = f"{output_dir}/{final_file}"                       
+        final_file = cls._final_file(self, output_dir, final_file)
 
         # run simulations and get timings
         for run in range(runs):
@@ -51,6 +64,8 @@ class HostSimulator:
         
         # export results
         subprocess.run(f"mv {self.output_file} {final_file}", shell=True)
+        if binary and self.output_format == 'dat':
+            final_file = dat2bin(final_file, program=self.name, keep_ascii=keep_ascii, **(meta or {}))
 
         # show timing statistics and save them if wanted
         print(f"{self.name} real time: {np.mean(sim_times[:,0]):.3f} +- {np.std(sim_times[:,0]):.3f} s")
@@ -222,4 +237,122 @@ class GATE(HostSimulator):
         
         HostSimulator.active_simulators[pid] = guest
         if self.verbose:
-            print(f"{guest.name} activated")
\ No newline at end of file
+            print(f"{guest.name} activated")
+
+@dataclass
+class SimJob:
+    name : str              # job name (work directory and log files)
+    guest : GuestSimulator  # simulator configuration
+    workdir : str           # isolated copy of the simulator's bash_dir
+    final_file : str        # where the output file is moved
+    binary : bool = False   # convert an ascii output into the binary container
+    keep_ascii : bool = False   # keep the ascii output after the conversion
+    meta : dict = None      # header of the binary container (isotope, material, seed, nhist)
+    time : float = None     # real time of the simulation (s)
+    returncode : int = None
+    error : str = None
+
+class SimScheduler:
+    """
+    Runs independent simulations of the active simulators concurrently in a bounded pool of workers.
+    Each code writes to fixed paths (e.g. penEasy/annihilation.dat), so submit copies the simulator folder
+    (bash_dir) as it is at that moment into its own work directory: inputs can be edited (InputEditor) 
+    and submitted job after job, and the jobs run later without interfering with each other.
+    stdout/stderr of every job are written to log_dir/<name>.out/.err.
+
+    Parameters:
+        workers (int): Number of simulations run at the same time (all cpus by default)
+        output_dir (str): Folder of the output files (as in HostSimulator.simulate)
+        scratch_dir (str): Folder of the job work directories
+        log_dir (str): Folder of the job logs
+        keep_workdirs (bool): Keep the work directories of successful jobs (failed ones are always kept)
+    """
+    def __init__(self, workers=None, output_dir="RESULTS", scratch_dir="scratch", log_dir="logs", keep_workdirs=False):
+        self.workers = workers or os.cpu_count()
+        self.output_dir = output_dir
+        self.scratch_dir = scratch_dir
+        self.log_dir = log_dir
+        self.keep_workdirs = keep_workdirs
+        self.pending = []
+        self.done = []
+
+    def submit(self, pid:str, final_file=None, binary=False, meta:dict=None, name=None, keep_ascii=False):
+        """Snapshots the current inputs of an active simulator as a new job (final_file, binary, meta and
+        keep_ascii as in simulate)"""
+        if pid not in HostSimulator.active_simulators.keys():
+            raise ValueError(f"Simulator with pid {pid} is not active")
+        guest = HostSimulator.active_simulators[pid]
+        final_file = HostSimulator._final_file(guest, self.output_dir, final_file)
+        name = name or f"{pid}_{len(self.pending) + len(self.done):04d}"
+        if any(job.final_file == final_file for job in self.pending):
+            raise ValueError(f"Another pending job writes {final_file}")
+
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        workdir = tempfile.mkdtemp(prefix=f"{name}_", dir=self.scratch_dir)
+        # the old output is not copied: a failed run must not look like a finished one
+        shutil.copytree(guest.bash_dir, os.path.join(workdir, guest.bash_dir), symlinks=True,
+                        ignore=shutil.ignore_patterns(os.path.basename(guest.output_file)))
+        job = SimJob(name, guest, workdir, final_file, binary, keep_ascii, meta)
+        self.pending.append(job)
+        return job
+
+    def _run(self, job:SimJob):
+        """Runs a job, any exception is stored in job.error (the job is never lost)"""
+        try:
+            self._execute(job)
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+        return job
+
+    def _execute(self, job:SimJob):
+        guest = job.guest
+        with open(f"{self.log_dir}/{job.name}.out", 'wb') as out, open(f"{self.log_dir}/{job.name}.err", 'wb') as err:
+            t_real = time.perf_counter()
+            job.returncode = subprocess.run(guest.simul_command, shell=True, cwd=os.path.join(job.workdir, guest.simul_dir),
+                                            stdout=out, stderr=err).returncode
+            job.time = time.perf_counter() - t_real
+
+        output_file = os.path.join(job.workdir, guest.output_file)
+        if job.returncode != 0:
+            job.error = f"exit code {job.returncode}"
+        elif not os.path.exists(output_file):
+            job.error = f"{guest.output_file} not written"
+        if job.error:
+            return
+
+        os.makedirs(os.path.dirname(job.final_file) or ".", exist_ok=True)
+        shutil.move(output_file, job.final_file)
+        if job.binary and guest.output_format == 'dat':
+            job.final_file = dat2bin(job.final_file, program=guest.name, keep_ascii=job.keep_ascii, **(job.meta or {}))
+        if not self.keep_workdirs:
+            shutil.rmtree(job.workdir)
+
+    def run(self):
+        """Runs the pending jobs (at most workers at the same time) and reports the throughput"""
+        jobs, self.pending = self.pending, []
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.done += jobs
+        t_wall = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:     # the work is done by the subprocesses
+                for future in as_completed([pool.submit(self._run, job) for job in jobs]):
+                    job = future.result()
+                    status = f"failed ({job.error}, see {self.log_dir}/{job.name}.err and {job.workdir})" if job.error else "finished"
+                    print(f"{job.name} ({job.guest.name}) {status} in {job.time or 0:.2f} sec")
+        finally:
+            t_wall = time.perf_counter() - t_wall
+            stats = self.report(jobs, t_wall)
+        return stats
+
+    def report(self, jobs:list[SimJob], t_wall:float):
+        """Prints and returns the throughput of finished jobs run in t_wall seconds"""
+        ok = [job for job in jobs if not job.error and job.returncode is not None]
+        t_jobs = sum(job.time or 0 for job in jobs)
+        nhist = sum(float((job.meta or {}).get('nhist') or 0) for job in ok)
+        stats = {'jobs': len(jobs), 'failed': len(jobs) - len(ok), 'wall_time': t_wall, 'jobs_time': t_jobs,
+                 'concurrency': t_jobs / t_wall if t_wall else 0, 'jobs_per_hour': 3600*len(ok) / t_wall if t_wall else 0,
+                 'histories_per_sec': nhist / t_wall if t_wall and nhist else None}
+        print(f"{stats['jobs']} jobs ({stats['failed']} failed) in {t_wall:.2f} sec: {stats['jobs_per_hour']:.1f} jobs/h, "
+              f"{stats['concurrency']:.1f} simulations running on average"
+              + (f", {stats['histories_per_sec']:.3g} histories/s" if nhist else ""))
+        return stats
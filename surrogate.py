@@ -0,0 +1,250 @@
+"""
+Surrogate of the fitted G3D of unseen (end-point energy Q, atomic number Z, density) combinations, built from
+the fits already stored under RESULTS/<case>/<material>/<code>_xyz/*_fit*_param.txt (study5/6).
+The fitted parameters are strongly correlated (e.g. b1 is often 0), so they are not interpolated directly:
+every single-branch fit is turned into its radii at fixed G3D levels (quantiles) and the quantiles are
+interpolated, which always gives a valid G3D and moves the curves smoothly:
+    - the radii are scaled by the density (mass radii, as the range scales as 1/density, see study3)
+    - log(mass radii) are interpolated in (log Q, Z, log density) with thin plate splines (scipy RBFInterpolator)
+    - G3D is a monotone cubic (pchip) of log r through the predicted quantiles, with a power law below
+      the first quantile (as (a*r)**n near 0) and an exponential tail after the last one
+Multi-branch isotopes are the weighted sum of the G3D of their branches (as MBfit_function). Distances are in mm.
+"""
+import os
+import numpy as np
+import sympy as sp
+from scipy.interpolate import RBFInterpolator, PchipInterpolator
+
+from betaplus import MB, SB
+from fitPRd import FitG3D, walk_results
+
+# mass densities (g/cm3) of the materials of RESULTS (study3/6)
+DENSITIES = {'Water': 1.00, 'Lung': 0.30, 'Bone': 1.45}
+Z_SCALE = 25    # Z is divided by Z_SCALE so its feature spans as much as log Q and log density
+
+def read_fit_file(file:str):
+    """
+    Reads a fit parameters file (blocks of '# Fitting function', '# Constants' and '# Isotope ...' header lines).
+    Returns:
+        list[dict]: {'isotope', 'function', 'constants', 'residue', 'rmse', 'chi2', 'params': {name: value}}
+    """
+    rows = []
+    function, constants, names = None, {}, []
+    with open(file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('# Fitting function:'):
+                function = line.split(':', 1)[1].strip()
+            elif line.startswith('# Constants:'):
+                consts = line.split(':', 1)[1].strip()
+                constants = {} if consts == 'None' else sp.sympify(consts)
+            elif line.startswith('# Isotope'):
+                names = line[1:].split()[4:]
+            else:
+                values = line.split()
+                rows.append({'isotope': values[0], 'function': function, 'constants': constants,
+                             'residue': float(values[1]), 'rmse': float(values[2]), 'chi2': float(values[3]),
+                             'params': dict(zip(names, map(float, values[4:])))})
+    return rows
+
+def find_fits(results_dir="RESULTS", cases=None, materials=None, codes=None):
+    """
+    Walks results_dir/<case>/<material>/<code>_xyz/ for fit parameters files (see walk_results).
+    Returns:
+        list[dict]: Rows of read_fit_file with 'case', 'material', 'code' and 'file'
+    """
+    fits = []
+    for case, material, code, folder in walk_results(results_dir, cases, materials, codes):
+        for name in sorted(os.listdir(folder)):
+            if '_fit' not in name or not name.endswith('_param.txt'): continue
+            file = os.path.join(folder, name)
+            fits += [{'case': case, 'material': material, 'code': code, 'file': file, **row}
+                     for row in read_fit_file(file)]
+    return fits
+
+def branches(isotope:str):
+    """
+    Branches of an isotope of SB/MB, or the single branch of '<MB isotope>-b<i>' (the MB case).
+    Returns:
+        list[tuple]: (Q in keV, Z, weight) per branch, weights normalized to 1
+    """
+    iso, _, b = isotope.partition('-b')
+    if iso not in SB and iso not in MB:
+        raise KeyError(f"Unknown isotope {iso}. Available isotopes are {list(SB) + list(MB)}")
+    data = SB[iso] if iso in SB else MB[iso]
+    selected = [data['branches'][int(b) - 1]] if b else data['branches']
+    total = sum(br[3] for br in selected)
+    return [(br[1], data['Z'], br[3]/total) for br in selected]
+
+def fitted_G3D(fit:dict):
+    """G3D callable of a stored fit (a row of read_fit_file)"""
+    names = list(fit['params'])
+    fit_func = FitG3D(sp.sympify(fit['function']), fit['constants'], dict.fromkeys(sp.symbols(names), (0, [0, None])),
+                      fit['function'])
+    fit_func.fitted_params = list(fit['params'].values())
+    return fit_func.get_G3D()
+
+def G3D_quantiles(G3D, levels, r=np.logspace(-4, 3, 8192)):
+    """Radii (mm) where a G3D callable reaches levels (r is the search grid)"""
+    G = np.maximum.accumulate(np.broadcast_to(G3D(r), r.shape))
+    return np.interp(levels, G, r)
+
+class QuantileG3D:
+    """
+    G3D(r) through the radii (mm) of increasing levels: monotone cubic in log r between the first and the last
+    level, (r/r0)**s0 power law below and exponential tail above, matching values and slopes at both ends.
+    """
+    def __init__(self, radii, levels):
+        self.radii = np.maximum.accumulate(radii) * (1 + 1e-9*np.arange(len(radii)))   # strictly increasing
+        self.levels = levels
+        self._G = PchipInterpolator(np.log(self.radii), levels, extrapolate=False)
+        self._dG = self._G.derivative()
+        q0, q1 = levels[0], levels[-1]
+        self._s0 = self._dG(np.log(self.radii[0])) / q0     # d log(G) / d log(r) at the first level
+        self._s1 = self._dG(np.log(self.radii[-1])) / self.radii[-1] / (1 - q1)   # decay rate of 1 - G
+
+    def G3D(self, r):
+        r = np.maximum(np.asarray(r, dtype=float), 1e-300)
+        (r0, r1), (q0, q1) = self.radii[[0, -1]], self.levels[[0, -1]]
+        G = self._G(np.log(r))
+        G = np.where(r < r0, q0*(r/r0)**self._s0, G)
+        return np.where(r > r1, 1 - (1 - q1)*np.exp(-self._s1*(r - r1)), G)
+
+    def g3D(self, r):
+        r = np.maximum(np.asarray(r, dtype=float), 1e-300)
+        (r0, r1), (q0, q1) = self.radii[[0, -1]], self.levels[[0, -1]]
+        g = self._dG(np.log(r)) / r
+        g = np.where(r < r0, q0*self._s0/r*(r/r0)**self._s0, g)
+        return np.where(r > r1, (1 - q1)*self._s1*np.exp(-self._s1*(r - r1)), g)
+
+    def aPSF3D(self, r):
+        return self.g3D(r) / np.asarray(r, dtype=float)**2
+
+class MixtureG3D:
+    """Weighted sum of the G3D of the branches of an isotope, with the getters of FitG3D"""
+    def __init__(self, curves:list, weights:list):
+        self.curves = curves
+        self.weights = np.asarray(weights) / np.sum(weights)
+
+    def G3D(self, r):
+        return sum(w*c.G3D(r) for w, c in zip(self.weights, self.curves))
+
+    def g3D(self, r):
+        return sum(w*c.g3D(r) for w, c in zip(self.weights, self.curves))
+
+    def aPSF3D(self, r):
+        return sum(w*c.aPSF3D(r) for w, c in zip(self.weights, self.curves))
+
+    def get_G3D(self):
+        return self.G3D
+
+    def get_g3D(self):
+        return self.g3D
+
+    def get_aPSF3D(self):
+        return self.aPSF3D
+
+class G3DSurrogate:
+    """
+    Interpolates the single-branch fits (four parameters, one branch: SB isotopes or MB branches '<iso>-b<i>')
+    in (Q, Z, density). Fits with several branches are kept in self.mixtures for validation only.
+
+    Parameters:
+        fits (list): Rows of find_fits / read_fit_file with 'material'
+        densities (dict): {material: mass density in g/cm3}
+        n_levels (int): Number of G3D levels (quantiles) interpolated
+        smoothing (float): Smoothing of the RBF interpolator (0 interpolates the fits exactly)
+        kernel (str): RBF kernel (see scipy RBFInterpolator)
+    """
+    def __init__(self, fits:list[dict], densities=DENSITIES, n_levels=200, smoothing=1e-3, kernel='thin_plate_spline'):
+        self.densities = densities
+        self.levels = (np.arange(n_levels) + 0.5) / n_levels
+        self.smoothing = smoothing
+        self.kernel = kernel
+
+        self.fits, self.mixtures = [], []
+        for fit in fits:
+            if fit['material'] not in densities:
+                continue
+            brs = branches(fit['isotope'])
+            if len(brs) == 1 and len(fit['params']) == 4:
+                self.fits.append(fit)
+            elif len(fit['params']) == 4*len(brs):
+                self.mixtures.append(fit)
+        if len(self.fits) < 4:
+            raise ValueError(f"Only {len(self.fits)} single-branch fits, at least 4 are needed to interpolate")
+
+        self.points = np.array([self._point(*branches(fit['isotope'])[0][:2], densities[fit['material']])
+                                for fit in self.fits])
+        self.targets = np.array([np.log(G3D_quantiles(fitted_G3D(fit), self.levels) * densities[fit['material']])
+                                 for fit in self.fits])
+        self._interp = RBFInterpolator(self.points, self.targets, kernel=kernel, smoothing=smoothing, degree=1)
+
+    @classmethod
+    def from_results(cls, results_dir="RESULTS", code="PenEasy2024", cases=None, **kwargs):
+        """Surrogate of the fits of one code under results_dir (all cases by default, see find_fits)"""
+        return cls(find_fits(results_dir, cases=cases, codes=[code]), **kwargs)
+
+    @staticmethod
+    def _point(Q, Z, density):
+        return [np.log(Q), Z / Z_SCALE, np.log(density)]
+
+    def quantiles(self, Q, Z, density):
+        """Predicted radii (mm) of the G3D levels of a branch of end-point energy Q (keV) and atomic number Z"""
+        logr = self._interp(np.array([self._point(Q, Z, density)]))[0]
+        return np.exp(np.maximum.accumulate(logr)) / density
+
+    def branch(self, Q, Z, density=1.0):
+        """Predicted G3D of a single branch (MixtureG3D with one branch, i.e. with get_G3D / get_aPSF3D)"""
+        return MixtureG3D([QuantileG3D(self.quantiles(Q, Z, density), self.levels)], [1.0])
+
+    def isotope(self, isotope:str, density=1.0):
+        """Predicted G3D of an SB/MB isotope (or MB branch '<iso>-b<i>') at a mass density"""
+        brs = branches(isotope)
+        return MixtureG3D([QuantileG3D(self.quantiles(Q, Z, density), self.levels) for Q, Z, _ in brs],
+                          [w for _, _, w in brs])
+
+    def get_G3D(self, isotope:str, density=1.0):
+        return self.isotope(isotope, density).G3D
+
+    def get_aPSF3D(self, isotope:str, density=1.0):
+        return self.isotope(isotope, density).aPSF3D
+
+    def _without(self, i):
+        """Surrogate without the i-th single-branch fit"""
+        held_out = object.__new__(G3DSurrogate)
+        held_out.__dict__.update(self.__dict__)
+        keep = np.arange(len(self.fits)) != i
+        held_out._interp = RBFInterpolator(self.points[keep], self.targets[keep], kernel=self.kernel,
+                                           smoothing=self.smoothing, degree=1)
+        return held_out
+
+    def validate(self, r=np.logspace(-3, 2, 2000), verbose=True):
+        """
+        Compares the surrogate with the stored fits:
+            - 'loo': each single-branch fit against the surrogate built without it (held-out)
+            - 'mixture': each multi-branch fit against the weighted sum of its predicted branches
+        Metrics are the max. |G3D difference| and the relative errors of the radii of 50% and 90%.
+        Returns:
+            list[dict]: {'kind', 'case', 'material', 'isotope', 'max_dG', 'err_r50', 'err_r90'}
+        """
+        def compare(kind, fit, surrogate):
+            density = self.densities[fit['material']]
+            G_fit, G_pred = fitted_G3D(fit), surrogate.get_G3D(fit['isotope'], density)
+            r_fit = G3D_quantiles(G_fit, [0.5, 0.9])
+            r_pred = G3D_quantiles(G_pred, [0.5, 0.9])
+            err = r_pred/r_fit - 1
+            return {'kind': kind, **{k: fit[k] for k in ('case', 'material', 'isotope')},
+                    'max_dG': float(np.max(np.abs(G_pred(r) - G_fit(r)))),
+                    'err_r50': float(err[0]), 'err_r90': float(err[1])}
+
+        rows = [compare('loo', fit, self._without(i)) for i, fit in enumerate(self.fits)]
+        rows += [compare('mixture', fit, self) for fit in self.mixtures]
+        if verbose:
+            print(f"{'kind':<8} {'case':<6} {'material':<8} {'isotope':<8} {'max|dG|':>8} {'r50':>7} {'r90':>7}")
+            for row in rows:
+                print(f"{row['kind']:<8} {row['case']:<6} {row['material']:<8} {row['isotope']:<8} "
+                      f"{row['max_dG']:8.4f} {row['err_r50']:+7.2%} {row['err_r90']:+7.2%}")
+        return rows
@@ -0,0 +1,45 @@
+"""Regression test of analysis.bin_coords against the original per-point loop and np.histogram"""
+import numpy as np
+import pytest
+
+from analysis import bin_coords
+
+SIZE = [7, 8, 5]
+STEP = [0.1, 0.25, 0.3]
+
+def loop_img(xp, yp, zp, SIZE, STEP):
+    """Image of the original PRAnalysis (one point at a time)"""
+    (NX, NY, NZ), (dx, dy, dz) = SIZE, STEP
+    img = np.zeros((NX, NY, NZ))
+    Xp = np.floor(xp/dx + NX/2).astype(int)
+    Yp = np.floor(yp/dy + NY/2).astype(int)
+    Zp = np.floor(zp/dz + NZ/2).astype(int)
+    for t in range(len(xp)):
+        if Xp[t] >= NX or Yp[t] >= NY or Zp[t] >= NZ or Xp[t] < 0 or Yp[t] < 0 or Zp[t] < 0:
+            continue
+        img[Xp[t], Yp[t], Zp[t]] += 1
+    return img
+
+def sample(dtype, n=20000, seed=1234):
+    """Seeded coords with points beyond the image and points exactly on the bin edges (and image limits)"""
+    rng = np.random.default_rng(seed)
+    coords = []
+    for N, d in zip(SIZE, STEP):
+        p = rng.normal(0, N*d/3, n)     # ~10% outside the image
+        edges = np.linspace(-N*d/2, N*d/2, N+1)
+        p[:n//4] = rng.choice(np.concatenate((edges, (np.arange(N+1) - N/2)*d)), n//4)
+        coords.append(p)
+    coords = np.array(coords)
+    coords[:, rng.permutation(n)[:n//4]] = coords[:, :n//4]     # edge values on all axes at once too
+    return [p.astype(dtype) for p in coords]
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_bin_coords(dtype):
+    xp, yp, zp = sample(dtype)
+    img, counts_1D = bin_coords(xp, yp, zp, SIZE, STEP)
+
+    np.testing.assert_array_equal(img, loop_img(xp, yp, zp, SIZE, STEP))
+    for p, N, d, counts in zip((xp, yp, zp), SIZE, STEP, counts_1D):
+        Pmax = N*d/2
+        np.testing.assert_array_equal(counts, np.histogram(p, bins=N, range=[-Pmax, Pmax])[0].astype('float64'))
+        assert counts.dtype == img.dtype == np.float64
@@ -0,0 +1,19 @@
+"""Fits of the compressed empirical G3D (compress_G3D) against the fits of the full sample"""
+import numpy as np
+import pytest
+
+from fitPRd import MBfit_function, check_compression
+
+def synthetic_G3D(a1, b1, c1, n1, n=int(2e5), seed=1234):
+    """Sorted sample (mm) drawn from the single-branch G3D and its empirical G3D (as load_nonhisto_G3D)"""
+    r = np.logspace(-5, 2, 100000)
+    G = 1 - np.exp(-(a1*r)**n1 - (b1*r)**2.5 - (c1*r)**3.5)
+    sample = np.sort(np.interp(np.random.default_rng(seed).random(n), G, r))
+    return sample, (np.arange(1, n+1) - 0.5)/n
+
+@pytest.mark.parametrize('params', [(1.0, 0.0, 0.4, 1.3),     # b1 at its 0 bound, as in many stored fits
+                                    (0.8, 0.5, 0.2, 1.05)])
+def test_compression_drift(params):
+    fit_func, _, _ = MBfit_function(100)
+    passed, results = check_compression(fit_func, *synthetic_G3D(*params), n_knots=4096, rmin=5e-2)
+    assert passed, results
@@ -0,0 +1,22 @@
+"""Memory bound of the voxel gridding (kernel.VG) when a single voxel has more than max_elems sub-sample distances"""
+import tracemalloc
+import numpy as np
+
+from kernel import VG
+
+def aPSF3D(r):
+    return np.exp(-r/0.5) / np.maximum(r, 1e-12)**2
+
+def test_VG_fine_griding_bounded_memory():
+    args = (aPSF3D, [0.1]*3, [3]*3, (0, None))
+    kwargs = dict(voxel_griding=9, source_griding=9, disable_tqdm=True)     # 81**3 = 531441 distances per voxel
+    reference = VG(*args, max_elems=int(2**24), **kwargs)      # whole voxels at once
+
+    max_elems = int(2**14)
+    tracemalloc.start()
+    chunked = VG(*args, max_elems=max_elems, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert peak < 16 * max_elems*8, f"peak {peak/2**20:.1f} MiB"    # a few float64 temporaries of max_elems
+    np.testing.assert_allclose(chunked, reference, rtol=1e-6)
@@ -0,0 +1,194 @@
+"""
+Fast condensed-history positron transport, a surrogate of the external codes run through simuls.HostSimulator.
+All positrons are transported at once (numpy arrays), each step losing a fixed fraction of the kinetic energy:
+    - emission energies from the isotope spectrum (betaplus.isotope_sampler), isotropic emission from the origin
+    - continuous slowing down with the Katz-Penfold CSDA range of water, scaled by the Z/A of the material
+      and by the local mass density (so path lengths in cm scale as 1/density)
+    - multiple scattering after each step with the Highland width (random hinge inside the step)
+    - the positron annihilates at rest where its energy falls below ecut (the residual range is travelled straight,
+      it is ~2 um at the default 10 keV)
+Annihilation in flight, positronium and energy straggling are not modelled.
+Annihilation coords are written in cm as the annihilation.dat files of the simulators (see annihilation.py).
+"""
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from annihilation import dat2bin
+from betaplus import isotope_sampler, mc2
+
+# Z/A and radiation length X0 (g/cm2) of the materials used in the phantoms (X0 from the elemental
+# composition with Dahl's formula, ICRP compositions for lung and cortical bone)
+MATERIALS = {
+    'water': (0.55508, 36.08),
+    'lung':  (0.54965, 36.20),
+    'bone':  (0.51478, 27.40),
+    'air':   (0.49919, 36.62),
+}
+
+def csda_range(E=None, logE=None):
+    """Katz-Penfold CSDA range of electrons/positrons in water (g/cm2), E in MeV (or its log)"""
+    logE = np.log(np.maximum(E, 1e-6)) if logE is None else logE
+    return 0.412 * np.exp(logE*(1.265 - 0.0954*logE))
+
+class Phantom:
+    """
+    Voxelized medium as given by InputEditor.get_newMaterial: MATERIAL indices and DENSITY (g/cm3) volumes
+    centred at the origin, axis 0 being x. Positions outside the volume take the nearest voxel.
+
+    Parameters:
+        MATERIAL (numpy.ndarray): Material index per voxel
+        DENSITY (numpy.ndarray): Mass density per voxel (g/cm3)
+        STEP (list): Voxel dimensions in cm [dx, dy, dz]
+        materials (dict): {material index: name in MATERIALS}
+    """
+    def __init__(self, MATERIAL, DENSITY, STEP, materials:dict):
+        unknown = {name for name in materials.values() if name not in MATERIALS}
+        if unknown:
+            raise KeyError(f"Unknown materials {unknown}. Available materials are {list(MATERIALS)}")
+        MATERIAL = np.asarray(MATERIAL)
+        zoa = np.zeros(MATERIAL.shape)
+        X0 = np.zeros(MATERIAL.shape)
+        for idx, name in materials.items():
+            zoa[MATERIAL == idx], X0[MATERIAL == idx] = MATERIALS[name]
+        if np.any(zoa == 0):
+            raise KeyError(f"Material indices {set(np.unique(MATERIAL[zoa == 0]))} are not in materials")
+
+        self.STEP = np.asarray(STEP, dtype=np.float64)
+        self.SIZE = np.array(MATERIAL.shape)
+        # a step of s g/cm2 of water is s*mass_scale g/cm2 of the material (stopping power ~ Z/A)
+        self.mass_scale = (MATERIALS['water'][0] / zoa).ravel().astype(np.float32)
+        self.density = np.asarray(DENSITY, dtype=np.float32).ravel()
+        self.X0 = X0.ravel().astype(np.float32)
+
+    @classmethod
+    def homogeneous(cls, material='water', density=1.0):
+        return cls(np.ones((1, 1, 1), dtype='int32'), np.full((1, 1, 1), density), [1.0]*3, {1: material})
+
+    @classmethod
+    def from_MATS(cls, MATS:dict, SIZE:list[int], STEP:list[float]):
+        """Phantom of InputEditor.get_newMaterial, MATS = {'mat name' : [mat id, mat index, density]}"""
+        from inputs import InputEditor
+        MATERIAL, DENSITY = InputEditor(verbose=False).get_newMaterial(MATS, SIZE, STEP)
+        return cls(MATERIAL, DENSITY, STEP, {v[1]: name.lower() for name, v in MATS.items()})
+
+    def lookup(self, xyz):
+        """Returns the (mass_scale, density, X0) of the voxels containing the positions xyz (n, 3) in cm"""
+        idx = np.clip(np.round(xyz / self.STEP).astype(np.int64) + self.SIZE//2, 0, self.SIZE - 1)
+        flat = np.ravel_multi_index(idx.T, self.SIZE)
+        return self.mass_scale[flat], self.density[flat], self.X0[flat]
+
+def _deflect(u, v, w, theta, cp, sp):
+    """Rotates the unit directions (u, v, w) by polar angles theta and azimuths of cosine cp and sine sp"""
+    ct, st = np.cos(theta), np.sin(theta)
+    s = np.sqrt(np.maximum(1 - w**2, 1e-12))    # directions along z are rotated about a slightly tilted axis
+    a, b = st*cp/s, st*sp/s
+    return u*ct + a*u*w - b*v, v*ct + a*v*w + b*u, w*ct - st*cp*s
+
+def transport(E, phantom:Phantom, frac=0.05, ecut=1e-2, rng=None):
+    """
+    Transports positrons emitted at the origin with kinetic energies E (MeV).
+
+    Parameters:
+        E (numpy.ndarray): Initial kinetic energies (MeV)
+        phantom (Phantom): Medium
+        frac (float): Fraction of the kinetic energy lost per step
+        ecut (float): Absorption energy (MeV)
+        rng: numpy Generator or seed
+    Returns:
+        numpy.ndarray: (n, 3) annihilation coords in cm
+    """
+    rng = np.random.default_rng(rng)
+    n = len(E)
+    out = np.zeros((n, 3))
+    homogeneous = len(phantom.density) == 1
+    if homogeneous:
+        mass_scale, density, X0 = phantom.mass_scale[0], phantom.density[0], phantom.X0[0]
+
+    # float32 working arrays of the positrons still moving (compacted as they stop)
+    idx = np.arange(n)
+    e = np.asarray(E, dtype=np.float32).copy()
+    loge = np.log(np.maximum(e, 1e-6))
+    R = csda_range(logE=loge)
+    x = np.zeros(n, np.float32); y = np.zeros(n, np.float32); z = np.zeros(n, np.float32)
+    w = rng.uniform(-1, 1, n).astype(np.float32)
+    phi = rng.uniform(0, 2*np.pi, n).astype(np.float32)
+    u = np.sqrt(1 - w**2) * np.cos(phi)
+    v = np.sqrt(1 - w**2) * np.sin(phi)
+
+    while len(idx):
+        m = len(idx)
+        if not homogeneous:
+            mass_scale, density, X0 = phantom.lookup(np.column_stack((x, y, z)))
+        e_next = e*(1 - frac)
+        loge_next = loge + np.float32(np.log(1 - frac))
+        last = e_next < ecut
+        e_next[last] = 0
+        R_next = csda_range(logE=loge_next)
+        R_next[last] = 0
+        s = (R - R_next) * mass_scale    # g/cm2 of the material
+
+        # Highland width of the step (mean energy of the step)
+        em = (e + e_next)/2
+        pbeta = (em**2 + 2*em*mc2) / (em + mc2)
+        t = np.maximum(s / X0, 1e-12)
+        theta0 = 13.6/pbeta * np.sqrt(t) * np.maximum(1 + 0.038*np.log(t), 0)
+        # projected angles are gaussian: their norm is the polar angle, their direction the azimuth
+        tx, ty = rng.standard_normal((2, m), dtype=np.float32)
+        norm = np.sqrt(tx**2 + ty**2) + 1e-30
+        theta = np.minimum(theta0 * norm, np.pi)
+
+        # random hinge: straight to the hinge, deflect, straight to the end of the step (no deflection at the end)
+        step = s / density
+        h = rng.random(m, dtype=np.float32) * step
+        x += h*u; y += h*v; z += h*w
+        theta[last] = 0
+        u, v, w = _deflect(u, v, w, theta, tx/norm, ty/norm)
+        h = step - h
+        x += h*u; y += h*v; z += h*w
+
+        if last.any():
+            out[idx[last]] = np.column_stack((x[last], y[last], z[last]))
+            keep = ~last
+            idx, e, loge, R, x, y, z, u, v, w = (a[keep] for a in (idx, e_next, loge_next, R_next, x, y, z, u, v, w))
+        else:
+            e, loge, R = e_next, loge_next, R_next
+    return out
+
+def _transport_chunk(isotope, n, phantom, frac, ecut, seed):
+    rng = np.random.default_rng(seed)
+    E = isotope_sampler(isotope).sample(n, rng) * 1e-3    # keV -> MeV
+    return transport(E, phantom, frac, ecut, rng)
+
+def simulate(isotope:str, nhist=int(1e6), phantom:Phantom=None, output_file=None, binary=False, frac=0.05,
+             ecut=1e-2, chunk_size=int(2**18), seed=None, workers=1, keep_ascii=False):
+    """
+    Simulates nhist positrons of an SB/MB isotope and returns their annihilation coords (cm), or writes them
+    to output_file as an annihilation.dat file (and converts it to the binary container if binary, removing
+    the ascii file unless keep_ascii).
+    Positrons are transported in chunks of chunk_size (bounding memory), in workers processes if workers > 1.
+    Every chunk has its own seed spawned from seed, so results do not depend on workers.
+    """
+    phantom = phantom or Phantom.homogeneous()
+    sizes = [min(chunk_size, int(nhist) - start) for start in range(0, int(nhist), chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = ([isotope]*len(sizes), sizes, [phantom]*len(sizes), [frac]*len(sizes), [ecut]*len(sizes), seeds)
+
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    chunks = pool.map(_transport_chunk, *args) if pool else map(_transport_chunk, *args)
+    coords = []
+    try:
+        if not output_file:
+            coords = list(chunks)
+        else:
+            with open(output_file, 'w') as f:
+                for xyz in chunks:
+                    np.savetxt(f, xyz, fmt='%.5e')
+    finally:
+        if pool:
+            pool.shutdown()
+
+    if not output_file:
+        return np.concatenate(coords)
+    if binary:
+        return dat2bin(output_file, keep_ascii=keep_ascii, isotope=isotope, program='transport', seed=seed, nhist=int(nhist))
+    return output_file